@@ -1,193 +1,761 @@
-import logging
 import asyncio
 import json
 import uuid
-import datetime
 import argparse
+import collections
+import multiprocessing
+import os
+import signal
 import socket
-import sys
+import time
+
+import logsetup
+import metrics
+import wire
+from aggregates import WindowAggregator
+from alarms import AlarmDedup
+from commands import CommandTracker, parse_ack, STATES, TYPE as COMMAND_TYPE, DEVICE as COMMAND_DEVICE
+from groups import PARTITIONS, DEVICE as PARTITION_DEVICE
+from history import ReadingHistory
+from lastvalue import LastValueCache
+from routing import RoutingIndex, Subscription, AGGREGATE
+from subscriber import Subscriber, POLICIES, BLOCK, DROP_OLDEST, NEVER_DROP
 
 
 class AggrServer:
 
-    def __init__(self, loop: asyncio.AbstractEventLoop, addr: str, port: int):
+    def __init__(self, loop: asyncio.AbstractEventLoop, addr: str, port: int, queue_size: int = 1000,
+                 client_policy: str = DROP_OLDEST, archive_policy: str = BLOCK, monitor_policy: str = NEVER_DROP,
+                 coalesce_window: float = 0.005, batch_size: int = 64, dedup_window: float = 5., worker: int = 0,
+                 workers: int = 1, peers: list = (), history_size: int = 1000, aggregate_intervals=(1., 10.),
+                 metrics_port: int = 0, command_timeout: float = 2.):
+        """
+        :param history_size: number of recent readings kept per device for replays, 0 disables
+        :param aggregate_intervals: lengths in seconds of the windows clients can subscribe to the aggregates of
+        :param worker: index of this worker process when the server runs on several cores
+        :param workers: number of worker processes sharing the listening port
+        :param peers: connected sockets to the other workers, readings and commands are exchanged through them
+        :param metrics_port: local port serving the metrics, every worker uses the port plus its index, 0 disables
+        :param command_timeout: time in seconds to wait for the acknowledgements of the devices to a command
+        """
         self.client_list = {}
         self.device_list = {}
         self.archive_list = {}
         self.monitor_list = {}
-        self.broadcast_task = None
 
-        # Initialization of logger
-        self.log = logging.getLogger('AggrServer')
-        handler = logging.StreamHandler(sys.stdout)
+        # Subscribers of the readings per sensor type and device
+        self.routes = RoutingIndex()
+
+        # Identical alarms from redundant monitors are only sent once
+        self.alarm_dedup = AlarmDedup(dedup_window)
+
+        # Binary protocol state, every worker uses its own handles so they are unique across workers
+        self.worker = worker
+        self.workers = workers
+        self.next_handle = worker + 1 - workers
+        self.protocol_count = collections.Counter()
+
+        # Devices connected to the other workers by handle
+        self.remote_devices = {}
 
-        # Datetime formatting setup
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
+        # Recent readings per device so consumers can recover the ones they missed
+        self.history_size = history_size
+        self.history = {}
 
-        self.log.addHandler(handler)
-        self.log.setLevel(logging.INFO)
+        # Latest value and state of every device and the active alarms, sent to new clients and monitors
+        self.last_values = LastValueCache()
+
+        # Device commands waiting for acknowledgements, and the last state commanded per sensor type
+        self.commands = CommandTracker(worker, workers)
+        self.command_timeout = command_timeout
+        self.type_states = {}
+
+        # Aggregates per device and sensor type over tumbling windows of every interval
+        self.aggregators = {float(interval): WindowAggregator(interval) for interval in aggregate_intervals}
+        self.aggregate_tasks = [loop.create_task(self.publish_aggregates(aggregator))
+                                for aggregator in self.aggregators.values()]
+
+        # Send queue setup per connection type
+        self.queue_size = queue_size
+        self.policies = {
+            'client': client_policy,
+            'archive': archive_policy,
+            'monitor': monitor_policy
+        }
+        self.coalesce_window = coalesce_window
+        self.batch_size = batch_size
+
+        # Initialization of logger, every reading is logged through a sampled logger
+        name = 'AggrServer' if workers == 1 else f'AggrServer[{worker}]'
+        self.log = logsetup.get_logger(name)
+        self.data_log = logsetup.get_logger(f'{name}.data', sampled=True)
 
         self.log.info('Started server')
 
-        self.server = loop.run_until_complete(asyncio.start_server(self.accept_connection, addr, port))
+        # Counters of the hot paths are plain integers, they are only read when the metrics are requested
+        self.device_stats = {}  # device id -> ConnectionStats
+        self.readings_received = 0
+        self.readings_switched_off = 0
+        self.alarms_sent = 0
+        self.alarms_duplicate = 0
+        self.metrics = metrics.Registry('aggr')
+        self.metrics.register(self.collect_metrics)
+        self.metrics_server = None
+
+        # The loop only keeps weak references to tasks, the ones nobody awaits are kept here until they are done
+        self.loop = loop
+        self.background_tasks = set()
+        if metrics_port:
+            self.loop_lag = metrics.LoopLag()
+            self.metrics.register(self.loop_lag.collect)
+            self.spawn(self.loop_lag.run())
+            self.metrics_server = loop.run_until_complete(metrics.serve(self.metrics, metrics_port + worker,
+                                                                        self.log))
+
+        # Readings and control messages exchanged with the other workers
+        self.peers = []
+        self.peer_tasks = []
+        loop.run_until_complete(self.connect_peers(peers))
 
-    async def send(self, writer: asyncio.StreamWriter, data: str):
+        self.server = loop.run_until_complete(asyncio.start_server(self.accept_connection, addr, port,
+                                                                   reuse_port=workers > 1))
+
+    def spawn(self, coro):
+        """
+        Run a coroutine in a background task that is kept until it is done and cancelled by `close`
+        """
+        task = self.loop.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, task: asyncio.Task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(f'Background task failed: {task.exception()!r}')
+
+    def close(self):
+        """
+        Cancel the background tasks on shutdown
+        """
+        for task in list(self.background_tasks):
+            task.cancel()
+
+    async def send(self, writer: asyncio.StreamWriter, data: str, protocol: str = wire.JSON):
         """
         Sending data to the connected client
         """
-        data += '\n'
         try:
-            writer.write(data.encode())
+            writer.write(wire.encode_text(data, protocol))
             await writer.drain()  # await to ensure task completion
         except socket.error as e:
             self.log.error(f"Socket error while sending data: {e}")
 
-    async def broadcast_to_devices(self, data: list[str]):
-        if len(data) < 2 or data[1] not in ['on', 'off']:
+    async def command(self, sub: Subscriber, kind: str, target: str, state: str):
+        """
+        Switch all the devices of a sensor type, or one device by ID, on any worker.
+
+        The client gets an `ACK:` reply once every device acknowledged the
+        change, or after the timeout with the devices that did not. Devices
+        that did not declare support for acknowledgements in the handshake
+        are sent the bare state and only counted.
+        """
+        if kind == COMMAND_DEVICE and target not in self.last_values.devices:
+            sub.offer(wire.encode_text(f'ERROR: Unknown device {target}', sub.protocol))
             return
 
-        for device_id in self.device_list:
-            reader, writer, device_type = self.device_list[device_id]
-            if data[0] == device_type:
-                await self.send(writer, data[1])
+        if kind == COMMAND_DEVICE:
+            targets = {target: self.last_values.devices[target]}
+        else:
+            targets = self.last_values.by_type.get(target, {})
+        expected = {device_id for device_id, status in targets.items() if status.acks}
+        command = self.commands.add(sub, kind, target, state, expected, len(targets) - len(expected))
+        self.forward({'cmd': 'command', 'target': kind, 'id': target, 'state': state, 'command': command.id})
+        await self.apply_command(kind, target, state, command.id)
+
+        if expected and command.id in self.commands.pending:
+            command.timer = asyncio.get_running_loop().call_later(self.command_timeout, self.finish_command,
+                                                                  command.id)
+        else:
+            self.finish_command(command.id)
+
+    async def apply_command(self, kind: str, target: str, state: str, command_id: int):
+        """
+        Update the state of the targeted devices and send the command to the ones connected to this worker.
+
+        Readings of switched off devices are not routed any more, even if a device keeps sending.
+        """
+        if kind == COMMAND_TYPE:
+            self.type_states[target] = state
+            device_ids = self.last_values.set_type_state(target, state)
+        else:
+            self.last_values.set_state(target, state)
+            device_ids = [target]
+
+        # Written to all the devices before waiting for any of them, legacy devices only understand the bare state
+        sends = []
+        for device_id in device_ids:
+            device = self.device_list.get(device_id)
+            if device is not None:
+                reader, writer, device_type, handle, protocol = device
+                acks = self.last_values.devices[device_id].acks
+                sends.append(self.send(writer, f'{state} {command_id}' if acks else state, protocol))
+        await asyncio.gather(*sends)
+
+    def device_ack(self, device_id: str, message: str):
+        """
+        Handle the acknowledgement of a command by a device of this worker
+        """
+        ack = parse_ack(message)
+        if ack is None:
+            self.log.warning(f'Invalid message from device {device_id}: {message}')
+            return
+        command_id, state = ack
+        self.last_values.set_state(device_id, state)
+        self.forward({'cmd': 'ack', 'command': command_id, 'id': device_id, 'state': state})
+        if self.commands.ack(command_id, device_id, state):
+            self.finish_command(command_id)
+
+    def finish_command(self, command_id: int):
+        """
+        Report the acknowledgements of a command to the client that issued it
+        """
+        command = self.commands.pop(command_id)
+        if command is None:
+            return
+        if command.timer is not None:
+            command.timer.cancel()
+        command.sub.offer(wire.encode_text(f'ACK: {json.dumps(command.result())}', command.sub.protocol))
+
+    async def connect_peers(self, peers: list):
+        """
+        Peer workers are sent data through the same kind of queue as the subscribers, in binary frames
+        """
+        for i, sock in enumerate(peers):
+            peer_id = f'worker{i if i < self.worker else i + 1}'
+            reader, writer = await asyncio.open_connection(sock=sock)
+            peer = Subscriber(peer_id, 'worker', writer, BLOCK, self.queue_size, self.log,
+                              coalesce_window=self.coalesce_window, batch_size=self.batch_size, protocol=wire.BINARY)
+            self.peers.append(peer)
+            self.peer_tasks.append(asyncio.create_task(self.handle_peer(peer, reader)))
+
+    def forward(self, message: dict):
+        """
+        Send a control message (command, alarm, group change, ...) to the other workers
+        """
+        if self.peers:
+            data = wire.encode_text(json.dumps(message), wire.BINARY)
+            for peer in self.peers:
+                peer.offer(data)
+
+    def encode(self, data: str) -> dict:
+        """
+        Encode a text message once per protocol so it can be shared by all the send queues
+        """
+        return {protocol: wire.encode_text(data, protocol) for protocol in self.protocol_count}
+
+    async def broadcast(self, subscribers, payloads: dict):
+        """
+        Enqueue data for every subscriber, waiting only on the ones with a full blocking queue
+
+        :param subscribers: list of subscribers, or a dict of them by connection id
+        :param payloads: encoded message for each protocol, subscribers of missing protocols are skipped
+        """
+        if isinstance(subscribers, dict):
+            subscribers = list(subscribers.values())
+
+        blocked = []
+        for sub in subscribers:
+            payload = payloads.get(sub.protocol)
+            if payload is not None and not sub.offer(payload):
+                blocked.append(sub.put(payload))
+        if blocked:
+            await asyncio.gather(*blocked)
 
     async def broadcast_to_clients(self, data: str):
-        for reader, writer in self.client_list.values():
-            await self.send(writer, data)
+        await self.broadcast(self.client_list, self.encode(data))
+
+    def monitor_overflow(self, subscriber: Subscriber):
+        """
+        Alert the clients that a monitor is not keeping up with the data
+        """
+        data = f'ALARM: Monitor {subscriber.id} is lagging, send queue over {subscriber.maxsize} messages'
+        self.alarms_sent += 1
+        alarm = self.encode(data)
+        for sub in list(self.client_list.values()):
+            sub.offer(alarm[sub.protocol])
+        self.forward({'cmd': 'alarm', 'data': data})
+
+    def queue_stats(self) -> dict:
+        """
+        Queue depth and drop counters of every subscriber
+        """
+        stats = {}
+        for subscribers in [self.client_list, self.archive_list, self.monitor_list]:
+            for conn_id, sub in subscribers.items():
+                stats[conn_id] = sub.stats()
+                if conn_id in self.routes.member_of:
+                    stats[conn_id]['group'] = self.routes.member_of[conn_id]
+        return stats
+
+    def collect_metrics(self, scrape: metrics.Scrape):
+        """
+        Connections, per connection traffic and queues, devices per type and alarms
+        """
+        subscribers = [sub for subscribers in [self.client_list, self.archive_list, self.monitor_list]
+                       for sub in subscribers.values()]
+        for conn_type, count in [('device', len(self.device_list)), ('client', len(self.client_list)),
+                                 ('archive', len(self.archive_list)), ('monitor', len(self.monitor_list))]:
+            scrape.gauge('connections', 'Connections to this worker by type', count, {'type': conn_type})
+
+        devices = collections.Counter((status.device_type, status.state)
+                                      for status in self.last_values.devices.values())
+        for (device_type, state), count in sorted(devices.items(), key=str):
+            scrape.gauge('devices', 'Connected devices of all the workers by sensor type and state', count,
+                         {'type': device_type, 'state': state})
 
-    async def broadcast_to_monitors(self, data: str):
-        for reader, writer in self.monitor_list.values():
-            await self.send(writer, data)
+        scrape.counter('readings_received_total', 'Readings received from the devices of this worker',
+                       self.readings_received)
+        scrape.counter('readings_switched_off_total', 'Readings of switched off devices that were not routed',
+                       self.readings_switched_off)
+        scrape.gauge('commands_pending', 'Device commands waiting for acknowledgements', len(self.commands.pending))
+        scrape.counter('alarms_sent_total', 'Alarms sent to the clients', self.alarms_sent)
+        scrape.counter('alarms_duplicate_total', 'Alarms of redundant monitors left out as duplicates',
+                       self.alarms_duplicate)
+        scrape.gauge('alarms_active', 'Active alarms', len(self.last_values.alarms))
+        for interval, aggregator in self.aggregators.items():
+            scrape.counter('aggregate_late_readings_total', 'Readings left out of the aggregates because their '
+                           'window was already closed', aggregator.late, {'interval': interval})
+
+        for device_id, stats in self.device_stats.items():
+            labels = {'conn': device_id, 'type': 'device'}
+            scrape.counter('messages_in_total', 'Messages received per connection', stats.received, labels)
+            scrape.counter('bytes_in_total', 'Bytes received per connection', stats.received_bytes, labels)
+        for sub in subscribers + self.peers:
+            labels = {'conn': sub.id, 'type': sub.type}
+            scrape.counter('messages_in_total', 'Messages received per connection', sub.received, labels)
+            scrape.counter('bytes_in_total', 'Bytes received per connection', sub.received_bytes, labels)
+            scrape.counter('messages_out_total', 'Messages sent per connection', sub.sent, labels)
+            scrape.counter('bytes_out_total', 'Bytes sent per connection', sub.sent_bytes, labels)
+            scrape.counter('writes_total', 'Coalesced socket writes per connection', sub.writes, labels)
+            scrape.counter('drain_wait_seconds_total', 'Time spent waiting for the socket to take the writes',
+                           sub.drain_time, labels)
+            scrape.counter('dropped_total', 'Messages dropped from the send queue', sub.dropped, labels)
+            scrape.gauge('queue_depth', 'Messages waiting in the send queue', len(sub.queue), labels)
+            scrape.gauge('queue_max_depth', 'Most messages that waited in the send queue', sub.max_depth, labels)
+
+    async def close_subscriber(self, subscribers: dict, conn_id: str):
+        """
+        Remove the subscriber and close its connection
+        """
+        sub = subscribers.pop(conn_id, None)
+        if conn_id in self.routes.member_of:
+            self.forward({'cmd': 'leave', 'id': conn_id})
+        self.routes.remove(conn_id)
+        if sub:
+            self.protocol_count[sub.protocol] -= 1
+            try:
+                await sub.close()
+            except Exception as e:
+                self.log.error(f'Error closing connection for {sub.type} {conn_id}: {e}')
 
-    async def broadcast_to_archives(self, data: str):
-        for reader, writer in self.archive_list.values():
-            await self.send(writer, data)
+    @staticmethod
+    async def read_message(reader: asyncio.StreamReader, protocol: str, stats=None):
+        """
+        Read a text message in the protocol of the connection
+
+        :param stats: counters of the received messages and bytes of the connection
+        :return: message or None when the connection is closed
+        """
+        if protocol == wire.BINARY:
+            frame = await wire.read_frame(reader)
+            if frame is None:
+                return None
+            kind, body = frame
+            if stats is not None:
+                stats.received += 1
+                stats.received_bytes += wire.HEADER.size + len(body)
+            return body.decode('utf-8').strip() if kind == wire.TEXT else ''
+
+        data = await reader.readline()
+        if not data:
+            return None
+        if stats is not None:
+            stats.received += 1
+            stats.received_bytes += len(data)
+        return data.decode('utf-8').strip()
 
     async def handle_client(self, device_id: str, reader: asyncio.StreamReader):
         """
         Handle the client response
         """
         self.log.info(f'Handling client: {device_id}')
+        sub = self.client_list[device_id]
         while True:
             try:
-                data = (await reader.readline()).decode('utf-8').strip()
+                data = await self.read_message(reader, sub.protocol, sub)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 self.log.warning(f'Error while reading from client {device_id}: {e}')
                 break
 
-            if not data:
-                del self.client_list[device_id]
+            if data is None:
                 break
 
             self.log.info(f'Client {device_id} data received: {data}')
+            if data == 'stats':
+                sub.offer(wire.encode_text(f'STATS: {json.dumps(self.queue_stats())}', sub.protocol))
+                continue
+
             data = data.split(' ')
-            if len(data) == 2:
-                await self.broadcast_to_devices(data)
+            if data[0] == 'status' and len(data) <= 2:
+                status = self.last_values.status(*data[1:])
+                sub.offer(wire.encode_text(f'STATUS: {json.dumps(status)}', sub.protocol))
+                continue
 
-        writer = self.client_list.get(device_id, None)
-        if writer:
-            try:
-                writer[1].close()
-                await writer[1].wait_closed()
-            except Exception as e:
-                self.log.error(f'Error closing connection for client {device_id}: {e}')
+            if data[0] in ['subscribe', 'unsubscribe']:
+                self.change_subscription(sub, data)
+                continue
+
+            # '<type> on/off' switches all the devices of a type, 'device <id> on/off' a single device
+            if len(data) == 2 and data[1] in STATES:
+                await self.command(sub, COMMAND_TYPE, data[0], data[1])
+            elif len(data) == 3 and data[0] == COMMAND_DEVICE and data[2] in STATES:
+                await self.command(sub, COMMAND_DEVICE, data[1], data[2])
+            else:
+                sub.offer(wire.encode_text(f'ERROR: Unknown command: {" ".join(data)}', sub.protocol))
+
+        await self.close_subscriber(self.client_list, device_id)
 
     async def handle_archive(self, device_id: str, reader: asyncio.StreamReader):
         """
         Handle the archive response
         """
         self.log.info(f'Handling archive: {device_id}')
+        sub = self.archive_list[device_id]
         while True:
             try:
-                data = (await reader.readline()).decode('utf-8').strip()
+                data = await self.read_message(reader, sub.protocol, sub)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 self.log.warning(f'Error while reading from archive {device_id}: {e}')
                 break
 
-            if not data:
-                del self.archive_list[device_id]
+            if data is None:
                 break
 
-        writer = self.archive_list.get(device_id, None)
-        if writer:
-            try:
-                writer[1].close()
-                await writer[1].wait_closed()
-            except Exception as e:
-                self.log.error(f'Error closing connection for archive {device_id}: {e}')
+            data = data.split(' ')
+            if data[0] == 'replay' and len(data) == 4:
+                self.spawn(self.replay(sub, data[1], data[2], data[3]))
+
+        await self.close_subscriber(self.archive_list, device_id)
 
     async def handle_monitor(self, device_id: str, reader: asyncio.StreamReader):
         """
         Handle the monitor response and send alarms to clients if any
         """
         self.log.info(f'Handling monitor: {device_id}')
+        sub = self.monitor_list[device_id]
         while True:
             try:
-                data = (await reader.readline()).decode('utf-8').strip()
+                data = await self.read_message(reader, sub.protocol, sub)
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 self.log.warning(f'Error while reading from monitor {device_id}: {e}')
                 break
 
-            if not data:
-                del self.monitor_list[device_id]
+            if data is None:
                 break
 
-            if data.split(' ')[0] == 'ALARM:':
-                await self.broadcast_to_clients(data)
+            for alarm in data.split('\n'):
+                if alarm.split(' ')[0] != 'ALARM:':
+                    continue
+                if self.alarm_dedup.is_duplicate(alarm, time.monotonic()):
+                    self.alarms_duplicate += 1
+                    continue
+                self.alarms_sent += 1
+                self.last_values.alarm(alarm)
+                self.forward({'cmd': 'alarm', 'data': alarm})
+                await self.broadcast_to_clients(alarm)
 
-        writer = self.monitor_list.get(device_id, None)
-        if writer:
-            try:
-                writer[1].close()
-                await writer[1].wait_closed()
-            except Exception as e:
-                self.log.error(f'Error closing connection for monitor {device_id}: {e}')
+        await self.close_subscriber(self.monitor_list, device_id)
 
     async def handle_device(self, device_id: str, reader: asyncio.StreamReader):
         """
         Broadcast the values from device
         """
         self.log.info(f'Handling device: {device_id}')
+        reader, writer, device_type, handle, protocol = self.device_list[device_id]
+        stats = self.device_stats[device_id] = metrics.ConnectionStats()
+        status = self.last_values.devices[device_id]
+        seq = 0
         while True:
             try:
-                date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                data = (await reader.readline()).decode('utf-8').strip()
+                if protocol == wire.BINARY:
+                    frame = await wire.read_frame(reader)
+                    if frame is None:
+                        break
+                    kind, body = frame
+                    stats.received += 1
+                    stats.received_bytes += wire.HEADER.size + len(body)
+                    if kind == wire.TEXT:
+                        self.device_ack(device_id, body.decode('utf-8'))
+                        continue
+                    if kind != wire.READING:
+                        continue
+                    received = time.time_ns()
+                    _, seq, ts, value, _, _ = wire.READING_BODY.unpack(body)
+                    data = repr(value)
+                else:
+                    line = await reader.readline()
+                    received = time.time_ns()
+                    if not line:
+                        break
+                    stats.received += 1
+                    stats.received_bytes += len(line)
+                    data = line.decode('utf-8').strip()
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 self.log.warning(f'Error while reading from device {device_id}: {e}')
                 break
 
-            if not data:
-                del self.device_list[device_id]
-                break
+            if protocol == wire.JSON:
+                if data.startswith('ACK:'):
+                    self.device_ack(device_id, data)
+                    continue
+                try:
+                    seq, ts, value, data = wire.decode_device_value(data, seq, received)
+                except (ValueError, TypeError, KeyError):
+                    self.log.warning(f'Invalid value from device {device_id}: {data}')
+                    continue
+
+            self.readings_received += 1
+            if status.state == 'off':
+                self.readings_switched_off += 1
+                continue
+            self.data_log.info('%s %s %s seq %d ts %d', device_id, device_type, data, seq, ts)
+            self.record(device_id, device_type, handle, seq, ts, value, data)
+
+            payloads = self.encode_reading(device_id, device_type, handle, seq, ts, value, data, received)
+            if self.peers:
+                frame = payloads.get(wire.BINARY) or wire.encode_reading(handle, seq, ts, value, received)
+                await self.broadcast(self.peers, {wire.BINARY: frame})
+            await self.broadcast(self.routes.route(device_id, device_type), payloads)
+
+        del self.device_list[device_id]
+        del self.device_stats[device_id]
+        self.forget_device(device_id)
+        self.forward({'cmd': 'device_lost', 'handle': handle})
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception as e:
+            self.log.error(f'Error closing connection for device {device_id}: {e}')
 
-            data = [date, (device_id, self.device_list[device_id][-1], data)]
-            data = json.dumps(data)
+    def encode_reading(self, device_id: str, device_type: str, handle: int, seq: int, ts: int, value: float,
+                       data: str, received: int = 0) -> dict:
+        """
+        Encode a reading only once for each protocol in use
+
+        :param received: time the reading was received from the device, stamped with the send time so consumers
+                         can measure the latency of every hop, 0 for readings not sent live (snapshots, replays)
+        """
+        sent = time.time_ns() if received else 0
+        payloads = {}
+        if self.protocol_count[wire.JSON]:
+            payloads[wire.JSON] = wire.encode_json(device_id, device_type, data, seq, ts, received, sent)
+        if self.protocol_count[wire.LEGACY]:
+            payloads[wire.LEGACY] = wire.encode_legacy(device_id, device_type, data, ts)
+        if self.protocol_count[wire.BINARY]:
+            payloads[wire.BINARY] = wire.encode_reading(handle, seq, ts, value, received, sent)
+        return payloads
+
+    def record(self, device_id: str, device_type: str, handle: int, seq: int, ts: int, value: float, data: str):
+        """
+        Keep the reading in the last value cache and the ring buffer of the device
+        """
+        self.last_values.update(device_id, seq, ts, value, data)
+        for aggregator in self.aggregators.values():
+            aggregator.add(device_id, device_type, ts, value)
+        if not self.history_size:
+            return
+        history = self.history.get(device_id)
+        if history is None:
+            history = self.history[device_id] = ReadingHistory(device_type, handle, self.history_size)
+        history.append(seq, (seq, ts, value, data))
+
+    async def publish_aggregates(self, aggregator: WindowAggregator):
+        """
+        Send the aggregates of every closed window to their subscribers
+        """
+        while True:
+            await asyncio.sleep(aggregator.next_close(time.time_ns()))
+            windows = aggregator.close(time.time_ns())
+            subscribers = [(sub, self.routes.subscriptions[conn_id])
+                           for conn_id, sub in self.routes.aggregates.items()
+                           if self.routes.subscriptions[conn_id].aggregate == aggregator.interval]
+            for window in windows:
+                # Subscribers of everything share one encoded message
+                shared = None
+                for sub, subscription in subscribers:
+                    if subscription.all:
+                        if shared is None:
+                            shared = self.encode(self.aggregate_message(aggregator, window))
+                        payload = shared[sub.protocol]
+                    else:
+                        payload = wire.encode_text(self.aggregate_message(aggregator, window, subscription.types,
+                                                                          subscription.devices), sub.protocol)
+                    sub.offer(payload)
+
+    @staticmethod
+    def aggregate_message(aggregator: WindowAggregator, window, types=None, devices=()) -> str:
+        message = {'interval': aggregator.interval, 'start': wire.format_time(window.start),
+                   **window.to_dict(types, devices)}
+        return f'AGGREGATE: {json.dumps(message)}'
 
-            self.log.info(data)
+    def forget_device(self, device_id: str):
+        """
+        Drop the cached routes, last value and history of a disconnected device
+        """
+        self.routes.forget(device_id)
+        self.history.pop(device_id, None)
+        self.last_values.remove_device(device_id)
+
+    async def replay(self, sub: Subscriber, device_id: str, start: str, end: str):
+        """
+        Send the readings of a device from its history to a subscriber that missed them.
+
+        Runs as its own task, the live readings keep flowing to the subscriber meanwhile.
+        """
+        try:
+            start, end = int(start), int(end)
+        except ValueError:
+            sub.offer(wire.encode_text(f'ERROR: Invalid replay range {start} {end}', sub.protocol))
+            return
+
+        history = self.history.get(device_id)
+        if history is None:
+            sub.offer(wire.encode_text(f'ERROR: No history of device {device_id}', sub.protocol))
+            return
+
+        entries = history.range(start, end)
+        for i, (seq, ts, value, data) in enumerate(entries):
+            payload = self.encode_reading(device_id, history.device_type, history.handle, seq, ts, value,
+                                          data)[sub.protocol]
+            if not sub.offer(payload):
+                await sub.put(payload)
+            if i % self.batch_size == self.batch_size - 1:
+                await asyncio.sleep(0)
 
-            await asyncio.gather(
-                self.broadcast_to_clients(data),
-                self.broadcast_to_archives(data),
-                self.broadcast_to_monitors(data),
-                return_exceptions=True
-            )
+        self.log.info(f'Replayed {len(entries)} readings of device {device_id} to {sub.type} {sub.id}')
+        sub.offer(wire.encode_text(f'REPLAYED: {device_id} {start} {end} {len(entries)}', sub.protocol))
 
-        writer = self.device_list.get(device_id, None)
-        if writer:
+    async def handle_peer(self, peer: Subscriber, reader: asyncio.StreamReader):
+        """
+        Route the readings of the devices connected to another worker and handle its control messages
+        """
+        devices = set()
+        members = set()
+        while True:
             try:
-                writer[1].close()
-                await writer[1].wait_closed()
+                frame = await wire.read_frame(reader, wire.MAX_MESSAGE)
+            except asyncio.CancelledError:
+                return
             except Exception as e:
-                self.log.error(f'Error closing connection for device {device_id}: {e}')
+                self.log.warning(f'Error while reading from {peer.id}: {e}')
+                break
+
+            if frame is None:
+                break
+
+            kind, body = frame
+            peer.received += 1
+            peer.received_bytes += wire.HEADER.size + len(body)
+            if kind == wire.READING:
+                handle, seq, ts, value, received, _ = wire.READING_BODY.unpack(body)
+                device = self.remote_devices.get(handle)
+                if device is None:
+                    continue
+                device_id, device_type = device
+                data = repr(value)
+                self.record(device_id, device_type, handle, seq, ts, value, data)
+                payloads = self.encode_reading(device_id, device_type, handle, seq, ts, value, data, received)
+                await self.broadcast(self.routes.route(device_id, device_type), payloads)
+
+            elif kind == wire.DEVICE:
+                handle, device_id, device_type = wire.decode_device(body)
+                self.remote_devices[handle] = (device_id, device_type)
+                self.last_values.add_device(device_id, device_type, handle)
+                devices.add(handle)
+                payloads = {wire.BINARY: wire.frame(kind, body)}
+                for subscribers in [self.client_list, self.archive_list, self.monitor_list]:
+                    await self.broadcast(subscribers, payloads)
+
+            elif kind == wire.TEXT:
+                message = json.loads(body)
+                if message['cmd'] == 'command':
+                    await self.apply_command(message['target'], message['id'], message['state'], message['command'])
+                elif message['cmd'] == 'ack':
+                    self.last_values.set_state(message['id'], message['state'])
+                    if self.commands.ack(message['command'], message['id'], message['state']):
+                        self.finish_command(message['command'])
+                elif message['cmd'] == 'alarm':
+                    if not self.alarm_dedup.is_duplicate(message['data'], time.monotonic()):
+                        self.last_values.alarm(message['data'])
+                        await self.broadcast_to_clients(message['data'])
+                elif message['cmd'] == 'state':
+                    self.last_values.set_state(message['id'], message['state'], message.get('acks'))
+                elif message['cmd'] == 'join':
+                    subscription = message.get('subscription')
+                    self.routes.add_remote(message['id'], message['group'], message['replicas'], message['partition'],
+                                           Subscription.from_dict(subscription) if subscription else None)
+                    members.add(message['id'])
+                elif message['cmd'] == 'subscription':
+                    self.routes.update_remote(message['id'], Subscription.from_dict(message['subscription']))
+                elif message['cmd'] == 'leave':
+                    self.routes.leave_group(message['id'])
+                    members.discard(message['id'])
+                elif message['cmd'] == 'device_lost':
+                    device = self.remote_devices.pop(message['handle'], None)
+                    devices.discard(message['handle'])
+                    if device is not None:
+                        self.forget_device(device[0])
+
+        # The devices and group members of a stopped worker are gone
+        self.log.error(f'Lost connection to {peer.id}')
+        for handle in devices:
+            device = self.remote_devices.pop(handle, None)
+            if device is not None:
+                self.forget_device(device[0])
+        for conn_id in members:
+            self.routes.leave_group(conn_id)
+
+    def new_handle(self) -> int:
+        """
+        Get a free small integer handle identifying a device in the binary protocol
+        """
+        used = {device[3] for device in self.device_list.values()}
+        while True:
+            self.next_handle += self.workers
+            if self.next_handle > wire.MAX_HANDLE:
+                self.next_handle = self.worker + 1
+            if self.next_handle not in used:
+                return self.next_handle
+
+    async def announce_device(self, device_id: str):
+        """
+        Send the handle of a new device to all binary subscribers
+        """
+        reader, writer, device_type, handle, protocol = self.device_list[device_id]
+        payloads = {wire.BINARY: wire.encode_device(handle, device_id, device_type)}
+        for subscribers in [self.client_list, self.archive_list, self.monitor_list, self.peers]:
+            await self.broadcast(subscribers, payloads)
+        status = self.last_values.devices[device_id]
+        self.forward({'cmd': 'state', 'id': device_id, 'state': status.state, 'acks': status.acks})
 
     async def get_conn_type(self, reader: asyncio.StreamReader):
         """
@@ -202,6 +770,114 @@ class AggrServer:
             self.log.warning(f'Error while getting connection type: {e}')
             return None
 
+    def change_subscription(self, sub: Subscriber, command: list):
+        """
+        Handle a 'subscribe/unsubscribe all/alarms/type <type>/device <id>/aggregate <interval>' command and
+        reply with the result
+        """
+        try:
+            if command[0] == 'subscribe' and command[1:2] == [AGGREGATE]:
+                self.check_interval(command[2] if len(command) > 2 else None)
+            subscription = self.routes.update(sub.id, command[0] == 'subscribe', *command[1:3])
+        except (TypeError, ValueError) as e:
+            sub.offer(wire.encode_text(f'ERROR: {e}', sub.protocol))
+            return
+        if sub.id in self.routes.member_of:
+            # The other workers route to the group members by their subscription
+            self.forward({'cmd': 'subscription', 'id': sub.id, 'subscription': subscription.to_dict()})
+        sub.offer(wire.encode_text(f'SUBSCRIBED: {json.dumps(subscription.to_dict())}', sub.protocol))
+
+    def check_interval(self, interval):
+        """
+        Aggregates are only computed for the configured intervals
+        """
+        if interval is not None and float(interval) not in self.aggregators:
+            raise ValueError(f'Unknown aggregate interval: {interval}, '
+                             f'available: {", ".join(map(str, self.aggregators))}')
+
+    @staticmethod
+    def parse_group(connection: dict) -> dict:
+        """
+        Consumer group settings from the handshake, e.g. {"group": "archives", "replicas": 2, "partition": "device"}
+        """
+        group = connection.get('group')
+        if group is None:
+            return {}
+        replicas = connection.get('replicas', 1)
+        partition = connection.get('partition', PARTITION_DEVICE)
+        if not isinstance(group, str) or not group:
+            raise ValueError(f'Invalid group name: {group}')
+        if not isinstance(replicas, int) or replicas < 1:
+            raise ValueError(f'Invalid replication factor: {replicas}')
+        if partition not in PARTITIONS:
+            raise ValueError(f'Unknown partition key: {partition}')
+        return {'group': group, 'replicas': replicas, 'partition': partition}
+
+    def new_subscriber(self, conn_id: str, conn_type: str, writer: asyncio.StreamWriter, protocol: str,
+                       subscription: Subscription, group: dict, on_overflow=None):
+        """
+        Create the send queue and writer task for a new connection
+
+        :param group: consumer group settings, the subscriber is not in a group if empty
+        """
+        sub = Subscriber(conn_id, conn_type, writer, self.policies[conn_type], self.queue_size, self.log,
+                         on_overflow=on_overflow, coalesce_window=self.coalesce_window,
+                         batch_size=self.batch_size, protocol=protocol)
+        self.protocol_count[protocol] += 1
+
+        # Devices owned by the other members of the group are moved, the rest keeps its members
+        if group and group['group'] in self.routes.groups:
+            existing = self.routes.groups[group['group']]
+            if (existing.replicas, existing.partition) != (group['replicas'], group['partition']):
+                self.log.warning(f'Group {existing.name} already uses {existing.replicas} replicas '
+                                 f'partitioned by {existing.partition}')
+        self.routes.add(sub, subscription, **group)
+        if group:
+            self.forward({'cmd': 'join', 'id': conn_id, 'subscription': subscription.to_dict(), **group})
+            self.log.info(f'{conn_type} {conn_id} joined group {group["group"]} '
+                          f'({len(self.routes.groups[group["group"]].members)} members)')
+
+        # Binary subscribers need the handles of the devices that are already connected
+        if protocol == wire.BINARY:
+            for device_id, (_, _, device_type, handle, _) in self.device_list.items():
+                sub.offer(wire.encode_device(handle, device_id, device_type))
+            for handle, (device_id, device_type) in self.remote_devices.items():
+                sub.offer(wire.encode_device(handle, device_id, device_type))
+
+        if conn_type in ['client', 'monitor']:
+            self.send_snapshot(sub)
+        return sub
+
+    def send_snapshot(self, sub: Subscriber):
+        """
+        Send the latest reading of the subscribed devices, and the active alarms to clients, to a new connection.
+
+        Legacy monitors parse every line as a reading, they only get the readings.
+        """
+        readings = 0
+        for device_id, status in self.last_values.readings():
+            if sub in self.routes.route(device_id, status.device_type):
+                sub.offer(self.encode_reading(device_id, status.device_type, status.handle, status.seq, status.ts,
+                                              status.value, status.data)[sub.protocol])
+                readings += 1
+
+        alarms = list(self.last_values.alarms.values()) if sub.type == 'client' else []
+        for alarm in alarms:
+            sub.offer(wire.encode_text(alarm, sub.protocol))
+        if sub.protocol == wire.LEGACY and sub.type == 'monitor':
+            return
+        sub.offer(wire.encode_text(f'SNAPSHOT: {json.dumps({"readings": readings, "alarms": len(alarms)})}',
+                                   sub.protocol))
+
+    def free_device_id(self, device_id) -> bool:
+        """
+        Check if a device ID requested in the handshake can be used
+        """
+        # IDs are separated by whitespace in the commands and archives
+        if not isinstance(device_id, str) or len(device_id) > 128 or device_id.split() != [device_id]:
+            return False
+        return device_id not in self.device_list and device_id not in self.last_values.devices
+
     async def accept_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """
         Accept a new connection and assign it a new device_id
@@ -211,37 +887,173 @@ class AggrServer:
             self.log.info(f'New connection established: {connection["type"]}')
 
             device_id = str(uuid.uuid4())
+            if connection['type'] == 'device' and self.free_device_id(connection.get('id')):
+                device_id = connection['id']  # e.g. devices replayed from an archive keep their IDs
+
+            protocol = connection.get('protocol', wire.JSON)
+            if protocol not in wire.PROTOCOLS:
+                self.log.warning(f'Unknown protocol: {protocol}')
+                writer.close()
+                return
+            if 'protocol' not in connection and connection['type'] in ['client', 'archive', 'monitor']:
+                protocol = wire.LEGACY  # older consumer, only sent what it understands
+
+            try:
+                subscription = Subscription.from_handshake(connection.get('subscribe'))
+                self.check_interval(subscription.aggregate)
+                group = self.parse_group(connection)
+            except (TypeError, ValueError) as e:
+                self.log.warning(f'Invalid subscription: {e}')
+                writer.close()
+                return
 
             if connection['type'] == 'client':
-                self.client_list[device_id] = (reader, writer)
+                self.client_list[device_id] = self.new_subscriber(device_id, 'client', writer, protocol,
+                                                                  subscription, group)
                 await self.handle_client(device_id, reader)
 
             elif connection['type'] == 'archive':
-                self.archive_list[device_id] = (reader, writer)
+                self.archive_list[device_id] = self.new_subscriber(device_id, 'archive', writer, protocol,
+                                                                   subscription, group)
                 await self.handle_archive(device_id, reader)
 
             elif connection['type'] == 'monitor':
-                self.monitor_list[device_id] = (reader, writer)
+                self.monitor_list[device_id] = self.new_subscriber(device_id, 'monitor', writer, protocol,
+                                                                   subscription, group,
+                                                                   on_overflow=self.monitor_overflow)
                 await self.handle_monitor(device_id, reader)
 
+            elif connection['type'] == 'status':
+                # One-off query of the current values, the connection is closed after the reply
+                status = self.last_values.status(connection.get('measurement'))
+                await self.send(writer, f'STATUS: {json.dumps(status)}', protocol)
+                writer.close()
+
             elif connection['type'] == 'device':
-                self.device_list[device_id] = (reader, writer, connection['measurement'])
+                handle = self.new_handle()
+                self.device_list[device_id] = (reader, writer, connection['measurement'], handle, protocol)
+                # Devices of a sensor type switched off by the operators start switched off
+                switched_off = self.type_states.get(connection['measurement']) == 'off'
+                self.last_values.add_device(device_id, connection['measurement'], handle,
+                                            'off' if switched_off else connection.get('state', 'on'),
+                                            acks=connection.get('ack') is True)
+                await self.announce_device(device_id)
+                if switched_off:
+                    await self.send(writer, 'off', protocol)
                 await self.handle_device(device_id, reader)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='New archive setup')
-    parser.add_argument('--addr', help='Server address', required=False, default='0.0.0.0')
-    parser.add_argument('--port', help='Server port', required=False, default=50000)
-    args = parser.parse_args()
-
-    loop = asyncio.get_event_loop()
-    server = AggrServer(loop, args.addr, int(args.port))
+def run_server(args: argparse.Namespace, worker: int = 0, workers: int = 1, peers: list = ()):
+    """
+    Run a server (or one of its workers) until interrupted
+    """
+    logsetup.configure(args.log_format, args.log_rate)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = AggrServer(loop, args.addr, int(args.port), queue_size=args.queue_size,
+                        client_policy=args.client_policy, archive_policy=args.archive_policy,
+                        monitor_policy=args.monitor_policy, coalesce_window=args.coalesce_ms / 1000,
+                        batch_size=args.batch_size, dedup_window=args.dedup_window, worker=worker,
+                        workers=workers, peers=peers, history_size=args.history,
+                        aggregate_intervals=args.aggregates, metrics_port=args.metrics_port,
+                        command_timeout=args.command_timeout)
     try:
         loop.run_forever()
     except KeyboardInterrupt as e:
+        server.close()
         tasks = [task for task in asyncio.all_tasks(loop) if task is not asyncio.current_task(loop)]
         for task in tasks:
             task.cancel()
         loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
         loop.close()
+
+
+def run_worker(args: argparse.Namespace, worker: int, sockets: list):
+    """
+    Entry point of a worker process, the sockets of the other workers inherited from the parent are closed
+    """
+    for i, peers in enumerate(sockets):
+        if i != worker:
+            for sock in peers:
+                sock.close()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    run_server(args, worker, len(sockets), sockets[worker])
+    logsetup.shutdown()  # worker processes exit without running the exit handlers
+
+
+def stop_workers(processes: list, grace: float = 1., timeout: float = 5.):
+    """
+    Wait for the workers to stop after an interrupt
+
+    Workers started from a terminal get the interrupt as well, the others are
+    interrupted after `grace` seconds. A worker interrupted in the middle of a
+    task can hang while closing, it is killed after `timeout` seconds.
+    """
+    for wait, stop in [(grace, lambda process: os.kill(process.pid, signal.SIGTERM)),
+                       (timeout, lambda process: process.kill())]:
+        deadline = time.monotonic() + wait
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+        for process in processes:
+            if process.is_alive():
+                stop(process)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='New archive setup')
+    parser.add_argument('--addr', help='Server address', required=False, default='0.0.0.0')
+    parser.add_argument('--port', help='Server port', required=False, default=50000)
+    parser.add_argument('--queue_size', help='Send queue size per connection', required=False, default=1000, type=int)
+    parser.add_argument('--client_policy', help='Overflow policy of client queues', required=False,
+                        default=DROP_OLDEST, choices=POLICIES)
+    parser.add_argument('--archive_policy', help='Overflow policy of archive queues', required=False,
+                        default=BLOCK, choices=POLICIES)
+    parser.add_argument('--monitor_policy', help='Overflow policy of monitor queues', required=False,
+                        default=NEVER_DROP, choices=POLICIES)
+    parser.add_argument('--coalesce_ms', help='Window in milliseconds for coalescing writes', required=False,
+                        default=5, type=float)
+    parser.add_argument('--batch_size', help='Maximum number of messages per coalesced write', required=False,
+                        default=64, type=int)
+    parser.add_argument('--dedup_window', help='Time in seconds in which identical alarms are sent only once',
+                        required=False, default=5, type=float)
+    parser.add_argument('--workers', help='Number of worker processes sharing the port', required=False,
+                        default=1, type=int)
+    parser.add_argument('--history', help='Number of recent readings kept per device for replays', required=False,
+                        default=1000, type=int)
+    parser.add_argument('--aggregates', help='Window lengths in seconds of the aggregates clients can subscribe to',
+                        required=False, default=[1., 10.], type=float, nargs='+')
+    parser.add_argument('--metrics_port', help='Local port serving the metrics, workers use the following ports '
+                                               '(0 disables)', required=False, default=0, type=int)
+    parser.add_argument('--command_timeout', help='Time in seconds to wait for the devices to acknowledge a command',
+                        required=False, default=2, type=float)
+    logsetup.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_server(args)
+    else:
+        # Every pair of workers is connected by a socket pair before starting the processes
+        sockets = [[] for _ in range(args.workers)]
+        for i in range(args.workers):
+            for j in range(i + 1, args.workers):
+                left, right = socket.socketpair()
+                sockets[i].append(left)
+                sockets[j].append(right)
+
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=run_worker, args=(args, i, sockets)) for i in range(args.workers)]
+        for process in processes:
+            process.start()
+        for sock in sum(sockets, []):
+            sock.close()
+
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt as e:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            stop_workers(processes)
@@ -0,0 +1,104 @@
+import math
+
+
+class Aggregate:
+    """
+    Running count, min, max, sum and last value of the readings in a window
+    """
+    __slots__ = ['count', 'min', 'max', 'total', 'last']
+
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.total = 0.
+        self.last = None
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'min': self.min, 'max': self.max, 'mean': self.total / self.count,
+                'last': self.last}
+
+
+class Window:
+    """
+    Aggregates of one interval per device and per sensor type
+    """
+    __slots__ = ['start', 'devices', 'types']
+
+    def __init__(self, start: int):
+        self.start = start  # nanoseconds since epoch
+        self.devices = {}  # device id -> (sensor type, Aggregate)
+        self.types = {}  # sensor type -> Aggregate
+
+    def to_dict(self, types=None, devices=()) -> dict:
+        """
+        :param types: only these sensor types and their devices, all if None
+        :param devices: devices included besides the ones of the types
+        """
+        return {
+            'types': {sensor_type: aggregate.to_dict() for sensor_type, aggregate in self.types.items()
+                      if types is None or sensor_type in types},
+            'devices': {device_id: {'type': sensor_type, **aggregate.to_dict()}
+                        for device_id, (sensor_type, aggregate) in self.devices.items()
+                        if types is None or sensor_type in types or device_id in devices}
+        }
+
+
+class WindowAggregator:
+    """
+    Tumbling windows of a fixed interval aggregated as the readings arrive.
+
+    A reading only updates the running aggregate of its device and of its sensor
+    type in the window of its timestamp, so closing a window never scans the
+    readings again. Windows are closed once their end is older than the grace
+    period, readings arriving for a closed window are counted as late.
+    """
+
+    def __init__(self, interval: float, grace: float = 0.2):
+        self.interval = interval
+        self.length = max(int(interval * 1_000_000_000), 1)
+        self.grace = int(grace * 1_000_000_000)
+        self.windows = {}  # window index -> Window
+        self.closed = None  # index of the first window still open
+        self.late = 0
+
+    def add(self, device_id: str, sensor_type: str, ts: int, value: float):
+        index = ts // self.length
+        if self.closed is not None and index < self.closed:
+            self.late += 1
+            return
+
+        window = self.windows.get(index)
+        if window is None:
+            window = self.windows[index] = Window(index * self.length)
+        entry = window.devices.get(device_id)
+        if entry is None:
+            entry = window.devices[device_id] = (sensor_type, Aggregate())
+        entry[1].add(value)
+        aggregate = window.types.get(sensor_type)
+        if aggregate is None:
+            aggregate = window.types[sensor_type] = Aggregate()
+        aggregate.add(value)
+
+    def close(self, now: int) -> list:
+        """
+        :param now: current time in nanoseconds
+        :return: windows that ended more than the grace period ago, oldest first
+        """
+        self.closed = (now - self.grace) // self.length
+        return [self.windows.pop(index) for index in sorted(self.windows) if index < self.closed]
+
+    def next_close(self, now: int) -> float:
+        """
+        Seconds until the current window can be closed
+        """
+        return (((now - self.grace) // self.length + 1) * self.length + self.grace - now) / 1_000_000_000
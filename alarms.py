@@ -0,0 +1,111 @@
+import collections
+
+from lastvalue import parse_alarm
+
+
+RAISED = 'raised'
+ACTIVE = 'active'
+CLEARED = 'cleared'
+
+LEVELS = {'warning': 1, 'critical': 2}
+
+
+class Alarm:
+    """
+    State of one alarm (device or sensor type and the check that fired)
+    """
+    __slots__ = ['level', 'message', 'notified', 'last_seen']
+
+    def __init__(self, level: str, message: str, now: float):
+        self.level = level
+        self.message = message
+        self.notified = now
+        self.last_seen = now
+
+
+class AlarmTracker:
+    """
+    Turns the stream of alarm conditions into state transitions.
+
+    A new condition raises the alarm, while it keeps firing the alarm is active
+    and is only notified again every `renotify` seconds (or right away when it
+    gets more severe). Alarms are cleared by the caller once the value is back in
+    range, or after `clear_after` seconds without the condition firing again.
+    """
+
+    def __init__(self, renotify: float = 60., clear_after: float = 10.):
+        self.renotify = renotify
+        self.clear_after = clear_after
+        self.active = {}
+
+    def fire(self, key: tuple, level: str, message: str, now: float):
+        """
+        :return: (state, message) if the operators have to be notified, otherwise None
+        """
+        alarm = self.active.get(key)
+        if alarm is None:
+            self.active[key] = Alarm(level, message, now)
+            return RAISED, message
+
+        alarm.last_seen = now
+        alarm.message = message
+        if LEVELS.get(level, 0) > LEVELS.get(alarm.level, 0):
+            alarm.level = level
+            alarm.notified = now
+            return RAISED, message
+        if now - alarm.notified >= self.renotify:
+            alarm.notified = now
+            return ACTIVE, message
+        return None
+
+    def clear(self, key: tuple):
+        """
+        :return: (state, message) if the alarm was active, otherwise None
+        """
+        alarm = self.active.pop(key, None)
+        if alarm is None:
+            return None
+        return CLEARED, alarm.message
+
+    def expire(self, now: float, keep=None) -> list:
+        """
+        Clear the alarms whose condition did not fire for `clear_after` seconds
+
+        :param keep: function telling which alarms are cleared by the caller instead
+        :return: list of (key, (state, message))
+        """
+        expired = [key for key, alarm in self.active.items()
+                   if now - alarm.last_seen >= self.clear_after and (keep is None or not keep(key))]
+        return [(key, self.clear(key)) for key in expired]
+
+
+class AlarmDedup:
+    """
+    Drops alarms already received from another monitor within a time window.
+
+    Alarms with a key are compared by key and state only, redundant monitors
+    see different batches and report different values and details for the
+    same alarm. An alarm is a duplicate if the last one of its key within the
+    window had the same state, so raising it again after it was cleared goes
+    through. Alarms without a key are compared by their full text.
+    """
+
+    def __init__(self, window: float = 5.):
+        self.window = window
+        self.recent = collections.deque()  # (time, key) in arrival order
+        self.seen = {}  # key -> (state, time) of the last alarm sent
+
+    def is_duplicate(self, alarm: str, now: float) -> bool:
+        while self.recent and now - self.recent[0][0] > self.window:
+            seen_at, key = self.recent.popleft()
+            if self.seen.get(key, (None, None))[1] == seen_at:
+                del self.seen[key]
+
+        parsed = parse_alarm(alarm)
+        key, state = parsed if parsed is not None else (alarm, None)
+        last = self.seen.get(key)
+        if last is not None and last[0] == state:
+            return True
+        self.seen[key] = (state, now)
+        self.recent.append((now, key))
+        return False
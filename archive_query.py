@@ -0,0 +1,222 @@
+import argparse
+import bisect
+import sys
+
+import wire
+from archive_store import Segment, list_segments, numpy
+
+
+GROUPS = ['device', 'type', 'all']
+
+
+class Aggregate:
+    """
+    Count, min, max and sum of the values in one bucket
+    """
+    __slots__ = ['count', 'min', 'max', 'sum']
+
+    def __init__(self, count: int, min_value: float, max_value: float, total: float):
+        self.count = count
+        self.min = min_value
+        self.max = max_value
+        self.sum = total
+
+    def merge(self, other: 'Aggregate'):
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count
+
+
+def row_range(segment: Segment, start: int, end: int) -> tuple:
+    """
+    Rows of the segment that can contain timestamps in [start, end), found with the sparse index
+    """
+    index = segment.index()
+    stride = segment.meta['index_stride']
+    if numpy is not None:
+        index_ts = numpy.asarray(index[0::2])
+        lo = int(numpy.searchsorted(index_ts, start, side='left'))
+        hi = int(numpy.searchsorted(index_ts, end, side='left'))
+    else:
+        index_ts = index[0::2]
+        lo = bisect.bisect_left(index_ts, start)
+        hi = bisect.bisect_left(index_ts, end)
+
+    # Entry lo is the first one at or after start, so matching rows can begin in the stride before it
+    return max(lo - 1, 0) * stride, min(hi * stride, segment.rows)
+
+
+def segment_filters(segment: Segment, devices: list, types: list) -> tuple:
+    """
+    Handles and type ids of the segment that match the requested devices and sensor types
+    """
+    handles = None
+    if devices is not None:
+        devices = set(devices)
+        handles = [handle for handle, (device_id, _) in enumerate(segment.devices) if device_id in devices]
+    type_ids = None
+    if types is not None:
+        type_ids = [type_id for type_id, sensor_type in enumerate(segment.types) if sensor_type in types]
+    return handles, type_ids
+
+
+def group_keys(segment: Segment, group: str) -> list:
+    """
+    Name of the group of every device handle of the segment
+    """
+    if group == 'device':
+        return [device_id for device_id, _ in segment.devices]
+    elif group == 'type':
+        return [sensor_type for _, sensor_type in segment.devices]
+    return ['all'] * len(segment.devices)
+
+
+def scan_numpy(segment: Segment, lo: int, hi: int, start: int, end: int, handles: list, type_ids: list):
+    """
+    Vectorized selection of the matching rows of a segment
+    """
+    ts = segment.column('ts')[lo:hi]
+    mask = (ts >= start) & (ts < end)
+    handle = segment.column('handle')[lo:hi]
+    if handles is not None:
+        mask &= numpy.isin(handle, handles)
+    if type_ids is not None:
+        mask &= numpy.isin(segment.column('type')[lo:hi], type_ids)
+    return ts[mask], handle[mask], segment.column('value')[lo:hi][mask]
+
+
+def scan_python(segment: Segment, lo: int, hi: int, start: int, end: int, handles: list, type_ids: list):
+    ts_col, handle_col, type_col, value_col = (segment.column(name) for name in ['ts', 'handle', 'type', 'value'])
+    handles = None if handles is None else set(handles)
+    type_ids = None if type_ids is None else set(type_ids)
+    ts, handle, value = [], [], []
+    for i in range(lo, hi):
+        if not start <= ts_col[i] < end:
+            continue
+        if handles is not None and handle_col[i] not in handles:
+            continue
+        if type_ids is not None and type_col[i] not in type_ids:
+            continue
+        ts.append(ts_col[i])
+        handle.append(handle_col[i])
+        value.append(value_col[i])
+    return ts, handle, value
+
+
+def aggregate_numpy(ts, handle, value, bucket: int, keys: list, result: dict):
+    """
+    Per bucket and group aggregation of the selected rows with sorted reductions
+    """
+    if len(ts) == 0:
+        return
+    group_names, group_ids = numpy.unique(numpy.asarray(keys, dtype=object), return_inverse=True)
+    groups = group_ids[handle]
+    buckets = ts // bucket
+    key = (buckets - buckets.min()) * len(group_names) + groups
+
+    order = numpy.argsort(key, kind='stable')
+    key, value, buckets, groups = key[order], value[order], buckets[order], groups[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], key[1:] != key[:-1])))
+
+    counts = numpy.diff(numpy.append(starts, len(key)))
+    mins = numpy.minimum.reduceat(value, starts)
+    maxs = numpy.maximum.reduceat(value, starts)
+    sums = numpy.add.reduceat(value, starts)
+    for i, row in enumerate(starts):
+        add_aggregate(result, (int(buckets[row]) * bucket, group_names[groups[row]]),
+                      Aggregate(int(counts[i]), float(mins[i]), float(maxs[i]), float(sums[i])))
+
+
+def aggregate_python(ts, handle, value, bucket: int, keys: list, result: dict):
+    for i in range(len(ts)):
+        add_aggregate(result, (ts[i] // bucket * bucket, keys[handle[i]]),
+                      Aggregate(1, value[i], value[i], value[i]))
+
+
+def add_aggregate(result: dict, key: tuple, aggregate: Aggregate):
+    # Buckets can span several segments, partial results are merged
+    current = result.get(key)
+    if current is None:
+        result[key] = aggregate
+    else:
+        current.merge(aggregate)
+
+
+def query(path: str, start: int = None, end: int = None, devices: list = None, types: list = None,
+          bucket: float = None, group: str = 'device') -> list:
+    """
+    Read readings of a columnar archive
+
+    :param path: directory of the columnar archive
+    :param start: start of the time range in nanoseconds (inclusive)
+    :param end: end of the time range in nanoseconds (exclusive)
+    :param devices: device IDs to include, all if None
+    :param types: sensor types to include, all if None
+    :param bucket: bucket size in seconds, raw readings are returned if None
+    :param group: aggregate per 'device', per sensor 'type' or 'all' together
+    :return: Reading objects or (bucket start, group, count, min, max, mean) tuples sorted by time
+    """
+    start = 0 if start is None else start
+    end = 2 ** 63 - 1 if end is None else end
+    bucket_ns = None if bucket is None else max(int(bucket * 1_000_000_000), 1)
+    scan = scan_numpy if numpy is not None else scan_python
+    aggregate = aggregate_numpy if numpy is not None else aggregate_python
+
+    readings = []
+    aggregates = {}
+    for segment_path in list_segments(path):
+        segment = Segment(segment_path)
+        # Segments entirely outside of the range are skipped using their metadata
+        if segment.rows == 0 or segment.max_ts < start or segment.min_ts >= end:
+            continue
+
+        handles, type_ids = segment_filters(segment, devices, types)
+        if handles == [] or type_ids == []:
+            continue
+
+        lo, hi = row_range(segment, start, end)
+        ts, handle, value = scan(segment, lo, hi, start, end, handles, type_ids)
+        if bucket_ns is None:
+            readings.extend(wire.Reading(int(ts[i]), *segment.devices[handle[i]], float(value[i]), 0)
+                            for i in range(len(ts)))
+        else:
+            aggregate(ts, handle, value, bucket_ns, group_keys(segment, group), aggregates)
+        segment.close()
+
+    if bucket_ns is None:
+        return readings
+    return [(bucket_start, name, agg.count, agg.min, agg.max, agg.mean)
+            for (bucket_start, name), agg in sorted(aggregates.items())]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query a columnar archive')
+    parser.add_argument('--path', help='Directory of the columnar archive', required=True)
+    parser.add_argument('--start', help='Start time (e.g. "2024-01-01 14:00:00")', required=False, default=None)
+    parser.add_argument('--end', help='End time (e.g. "2024-01-01 14:05:00")', required=False, default=None)
+    parser.add_argument('--device', help='Device ID to include, can be repeated', required=False, action='append')
+    parser.add_argument('--type', help='Sensor type to include, can be repeated', required=False, action='append')
+    parser.add_argument('--bucket', help='Bucket size in seconds for min/max/mean/count', required=False,
+                        default=None, type=float)
+    parser.add_argument('--group', help='Aggregate per device, type or all', required=False, default='device',
+                        choices=GROUPS)
+    args = parser.parse_args()
+
+    start = None if args.start is None else wire.parse_time(args.start)
+    end = None if args.end is None else wire.parse_time(args.end)
+    result = query(args.path, start, end, args.device, args.type, args.bucket, args.group)
+
+    out = sys.stdout
+    if args.bucket is None:
+        out.write('\t'.join(['Timestamp', 'ID', 'Sensor_Type', 'Value']) + '\n')
+        for row in result:
+            out.write(f'{wire.format_time(row.ts)}\t{row.device_id}\t{row.sensor_type}\t{row.value!r}\n')
+    else:
+        out.write('\t'.join(['Timestamp', 'Group', 'Count', 'Min', 'Max', 'Mean']) + '\n')
+        for bucket_start, name, count, min_value, max_value, mean in result:
+            out.write(f'{wire.format_time(bucket_start)}\t{name}\t{count}\t{min_value!r}\t{max_value!r}\t{mean!r}\n')
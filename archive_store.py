@@ -0,0 +1,530 @@
+import argparse
+import array
+import gzip
+import json
+import logging
+import mmap
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+import wire
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, columns are then returned as memoryviews
+    numpy = None
+
+
+HEADER = ['Timestamp', 'ID', 'Sensor_Type', 'Value']
+
+# Fixed width columns of a segment: file name, array typecode, NumPy dtype
+COLUMNS = {
+    'ts': ('ts.i64', 'q', '<i8'),
+    'handle': ('handle.i32', 'i', '<i4'),
+    'type': ('type.u8', 'B', 'u1'),
+    'value': ('value.f64', 'd', '<f8'),
+}
+
+INDEX_FILE = 'index.i64'  # sparse time index, pairs of (timestamp, row)
+META_FILE = 'meta.json'
+
+MIN_WAIT = 0.05  # shortest wait of the writer thread for new batches, so fsync_interval 0 does not spin
+
+
+def format_rows(rows: list) -> str:
+    return ''.join(f'{wire.format_time(row.ts)}\t{row.device_id}\t{row.sensor_type}\t{row.value!r}\n' for row in rows)
+
+
+def compress_path(path: str):
+    """
+    Compress a closed TSV file or all the column files of a closed segment with gzip
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path) if name != META_FILE]
+    else:
+        paths = [path]
+
+    for path in paths:
+        if path.endswith('.gz'):
+            continue
+        with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+
+
+class TsvWriter:
+    """
+    Archive stored as a tab-separated text file, rotated files are numbered
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.filepath, 'a+')
+        if os.stat(self.filepath).st_size == 0:
+            self.file.write('\t'.join(HEADER))
+            self.file.write('\n')
+        self.opened_at = time.monotonic()
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def write(self, rows: list):
+        if rows:
+            self.file.write(format_rows(rows))
+
+    def size(self) -> int:
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def rotate(self) -> str:
+        """
+        Close the current file under a numbered name and start a new one
+
+        :return: path of the closed file
+        """
+        self.file.close()
+        base, ext = os.path.splitext(self.filepath)
+        number = 1
+        while os.path.exists(f'{base}.{number:04d}{ext}') or os.path.exists(f'{base}.{number:04d}{ext}.gz'):
+            number += 1
+        closed_path = f'{base}.{number:04d}{ext}'
+        os.replace(self.filepath, closed_path)
+        self.open()
+        return closed_path
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarWriter:
+    """
+    Archive stored as append-only segments of fixed width binary columns.
+
+    Each segment is a directory with one file per column (timestamp int64,
+    device handle int32, type id uint8, value float64, little-endian), a sparse
+    time index with an entry every `index_stride` rows and a meta.json file that
+    maps the handles and type ids back to device IDs and sensor types. Rows have
+    to be written in time order for the index to be valid.
+    """
+
+    def __init__(self, directory: str, segment_rows: int = 1_000_000, index_stride: int = 1024):
+        self.directory = directory
+        self.segment_rows = segment_rows
+        self.index_stride = index_stride
+        self.files = None
+        self.segment = None
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.next_segment = len([name for name in os.listdir(directory) if name.startswith('seg-')]) + 1
+        self.open_segment()
+
+    def open_segment(self):
+        self.segment = os.path.join(self.directory, f'seg-{self.next_segment:06d}')
+        self.next_segment += 1
+        os.makedirs(self.segment)
+
+        self.paths = {name: os.path.join(self.segment, filename) for name, (filename, _, _) in COLUMNS.items()}
+        self.paths['index'] = os.path.join(self.segment, INDEX_FILE)
+        self.files = {name: open(path, 'ab') for name, path in self.paths.items()}
+        self.rows = 0
+        self.devices = {}  # device id -> handle
+        self.device_list = []  # handle -> (device id, type)
+        self.types = {}  # sensor type -> type id
+        self.meta_changed = True
+        self.min_ts = None
+        self.max_ts = None
+        self.opened_at = time.monotonic()
+        self.write_meta()
+
+    def close_segment(self):
+        self.write_meta()
+        for file in self.files.values():
+            file.close()
+
+    def write_meta(self):
+        if not self.meta_changed:
+            return
+        meta = {
+            'rows': self.rows,
+            'min_ts': self.min_ts,
+            'max_ts': self.max_ts,
+            'index_stride': self.index_stride,
+            'devices': self.device_list,
+            'types': list(self.types)
+        }
+        tmp = os.path.join(self.segment, META_FILE + '.tmp')
+        with open(tmp, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp, os.path.join(self.segment, META_FILE))
+        self.meta_changed = False
+
+    def write(self, rows: list):
+        while rows:
+            if self.rows >= self.segment_rows:
+                self.close_segment()
+                self.open_segment()
+
+            count = min(len(rows), self.segment_rows - self.rows)
+            self.write_segment(rows[:count])
+            rows = rows[count:]
+
+    def write_segment(self, rows: list):
+        columns = {name: array.array(typecode) for name, (_, typecode, _) in COLUMNS.items()}
+        index = array.array('q')
+
+        ts_col, handle_col, type_col, value_col = columns['ts'], columns['handle'], columns['type'], columns['value']
+        row_number = self.rows
+        for row in rows:
+            handle = self.devices.get(row.device_id)
+            if handle is None:
+                handle = self.add_device(row.device_id, row.sensor_type)
+            type_id = self.types.get(row.sensor_type)
+            if type_id is None:
+                type_id = self.add_type(row.sensor_type)
+
+            if row_number % self.index_stride == 0:
+                index.append(row.ts)
+                index.append(row_number)
+            ts_col.append(row.ts)
+            handle_col.append(handle)
+            type_col.append(type_id)
+            value_col.append(row.value)
+            row_number += 1
+
+        if sys.byteorder == 'big':
+            for column in list(columns.values()) + [index]:
+                column.byteswap()
+
+        # The columns are flushed with every batch, so all the files end at a row boundary before it
+        offsets = {name: file.tell() for name, file in self.files.items()}
+        try:
+            for name, column in columns.items():
+                column.tofile(self.files[name])
+            index.tofile(self.files['index'])
+            for file in self.files.values():
+                file.flush()
+        except OSError:
+            self.truncate(offsets)
+            raise
+
+        if self.min_ts is None:
+            self.min_ts = rows[0].ts
+        self.max_ts = rows[-1].ts
+        self.rows = row_number
+        self.meta_changed = True
+
+    def truncate(self, offsets: dict):
+        """
+        Cut the column files back to the given sizes after a failed write, so every column keeps the same rows
+        """
+        try:
+            for name, file in self.files.items():
+                try:
+                    file.close()  # the rows left in the buffer are discarded
+                except OSError:
+                    pass
+                os.truncate(self.paths[name], offsets[name])
+            self.files = {name: open(path, 'ab') for name, path in self.paths.items()}
+        except OSError as e:
+            raise RuntimeError(f'Could not restore the columns of {self.segment} after a failed write: {e}') from e
+
+    def add_device(self, device_id: str, sensor_type: str) -> int:
+        handle = len(self.device_list)
+        self.devices[device_id] = handle
+        self.device_list.append((device_id, sensor_type))
+        return handle
+
+    def add_type(self, sensor_type: str) -> int:
+        if len(self.types) > 0xFF:
+            raise ValueError('Too many sensor types for one segment')
+        type_id = len(self.types)
+        self.types[sensor_type] = type_id
+        return type_id
+
+    def size(self) -> int:
+        return sum(file.tell() for file in self.files.values())
+
+    def flush(self):
+        for file in self.files.values():
+            file.flush()
+        self.write_meta()
+
+    def sync(self):
+        # Columns are made durable before the metadata that declares their rows
+        for file in self.files.values():
+            file.flush()
+            os.fsync(file.fileno())
+        self.write_meta()
+
+    def rotate(self) -> str:
+        """
+        Close the current segment and start a new one
+
+        :return: path of the closed segment
+        """
+        closed_path = self.segment
+        self.close_segment()
+        self.open_segment()
+        return closed_path
+
+    def close(self):
+        if not self.closed:
+            self.close_segment()
+            self.closed = True
+
+
+class BackgroundWriter:
+    """
+    Writes the archive rows in a background thread so the disk never stalls the event loop.
+
+    Rows are collected into batches and handed to the thread, which writes every
+    batch that is waiting and then commits them together with a single fsync once
+    the sync interval or row count is reached. The file is rotated by size or
+    age and closed files can be compressed.
+
+    Handing over a batch never blocks: when the queue is full the rows stay
+    pending and `backlogged` tells the caller to stop reading until the disk
+    has caught up.
+
+    If the writer fails with anything but an I/O error it is not used again:
+    the error is kept in `error`, the batches still queued and all the rows
+    written afterwards are dropped and counted in `dropped`, so the event loop
+    never blocks on a queue that nothing drains.
+    """
+
+    def __init__(self, writer, log: logging.Logger, batch_rows: int = 1000, fsync_interval: float = 1.,
+                 fsync_rows: int = 10000, rotate_size: int = 0, rotate_interval: float = 0., compress: bool = False,
+                 max_batches: int = 64):
+        self.writer = writer
+        self.log = log
+        self.batch_rows = batch_rows
+        self.fsync_interval = fsync_interval
+        self.fsync_rows = fsync_rows
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+
+        self.pending = []
+        self.queue = queue.Queue(max_batches)
+        self.closed = False
+        self.error = None
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='ArchiveWriter', daemon=True)
+        self.thread.start()
+
+    def write(self, rows: list):
+        self.pending.extend(rows)
+        if len(self.pending) >= self.batch_rows:
+            self.flush()
+
+    def flush(self) -> bool:
+        """
+        Hand the collected rows to the writer thread
+
+        :return: False if the queue is full and the rows are still pending
+        """
+        if self.pending:
+            if self.error is not None:
+                self.drop(self.pending)
+            else:
+                try:
+                    self.queue.put_nowait(self.pending)
+                except queue.Full:
+                    return False
+            self.pending = []
+        return True
+
+    @property
+    def backlogged(self) -> bool:
+        """
+        Whether a full batch is waiting for room in the queue, new rows should not be read meanwhile
+        """
+        return len(self.pending) >= self.batch_rows and self.queue.full()
+
+    def drop(self, rows: list):
+        self.dropped += len(rows)
+
+    def close(self):
+        if self.closed:
+            return
+        # The remaining rows are waited for at shutdown
+        if self.pending and self.error is None:
+            self.queue.put(self.pending)
+        self.pending = []
+        self.queue.put(None)
+        self.thread.join()
+        self.closed = True
+
+    def run(self):
+        unsynced = 0
+        written = 0  # rows in the current file
+        last_sync = time.monotonic()
+        running = True
+        while running:
+            try:
+                batches = [self.queue.get(timeout=max(self.fsync_interval, MIN_WAIT))]
+            except queue.Empty:
+                batches = []
+
+            # Group commit of all the batches that are already waiting
+            while batches and batches[-1] is not None and not self.queue.empty():
+                batches.append(self.queue.get_nowait())
+            if batches and batches[-1] is None:
+                batches.pop()
+                running = False
+
+            if self.error is not None:
+                for batch in batches:
+                    self.drop(batch)
+                continue
+
+            done = 0  # batches written, the rest is dropped if the writer fails
+            try:
+                for batch in batches:
+                    self.writer.write(batch)
+                    unsynced += len(batch)
+                    written += len(batch)
+                    done += 1
+
+                now = time.monotonic()
+                if unsynced and (unsynced >= self.fsync_rows or now - last_sync >= self.fsync_interval):
+                    self.writer.sync()
+                    unsynced = 0
+                    last_sync = now
+
+                if written and ((self.rotate_size and self.writer.size() >= self.rotate_size) or
+                                (self.rotate_interval and now - self.writer.opened_at >= self.rotate_interval)):
+                    self.rotate()
+                    written = 0
+            except OSError as e:
+                # The rows of the failed batch were taken back out of the file, they and the rest are lost
+                lost = sum(len(batch) for batch in batches[done:])
+                self.dropped += lost
+                self.log.error(f'Error while writing archive, {lost} rows dropped: {e}')
+            except Exception as e:
+                self.log.exception(f'Archive writer failed, all the following rows are dropped: {e}')
+                self.error = e
+                for batch in batches[done:]:
+                    self.drop(batch)
+
+        try:
+            self.writer.sync()
+            self.writer.close()
+        except Exception as e:
+            self.log.error(f'Error while closing archive: {e}')
+
+    def rotate(self):
+        self.writer.sync()
+        closed_path = self.writer.rotate()
+        self.log.info(f'Rotated archive to {closed_path}')
+        if self.compress:
+            compress_path(closed_path)
+
+
+def list_segments(directory: str) -> list:
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.startswith('seg-') and os.path.exists(os.path.join(directory, name, META_FILE)))
+
+
+class Segment:
+    """
+    Read-only view of a columnar segment, columns are memory-mapped without copying
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as file:
+            self.meta = json.load(file)
+        self.rows = self.meta['rows']
+        self.min_ts = self.meta['min_ts']
+        self.max_ts = self.meta['max_ts']
+        self.devices = [tuple(device) for device in self.meta['devices']]
+        self.types = self.meta['types']
+        self.maps = []
+
+    def map_file(self, filename: str, typecode: str, dtype: str, count: int):
+        """
+        Memory-map a column file as a NumPy array, or a memoryview if NumPy is not installed
+        """
+        if count == 0:
+            return numpy.empty(0, dtype) if numpy is not None else memoryview(array.array(typecode))
+
+        path = os.path.join(self.path, filename)
+        if os.path.exists(path + '.gz'):
+            # Compressed segments are decompressed into memory instead
+            with gzip.open(path + '.gz', 'rb') as file:
+                data = file.read()
+        else:
+            with open(path, 'rb') as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps.append(data)
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype=dtype, count=count)
+        return memoryview(data).cast(typecode)[:count]
+
+    def column(self, name: str):
+        filename, typecode, dtype = COLUMNS[name]
+        return self.map_file(filename, typecode, dtype, self.rows)
+
+    def index(self):
+        """
+        Sparse time index as a flat sequence of (timestamp, row) pairs
+        """
+        count = (self.rows + self.meta['index_stride'] - 1) // self.meta['index_stride'] * 2
+        return self.map_file(INDEX_FILE, 'q', '<i8', count)
+
+    def readings(self, start: int = 0, stop: int = None):
+        """
+        Iterate over the rows of the segment as readings
+        """
+        stop = self.rows if stop is None else stop
+        ts, handle, value = self.column('ts'), self.column('handle'), self.column('value')
+        for i in range(start, stop):
+            device_id, sensor_type = self.devices[handle[i]]
+            yield wire.Reading(int(ts[i]), device_id, sensor_type, float(value[i]), 0)
+
+    def close(self):
+        self.maps = []  # mappings are closed once the arrays using them are released
+
+
+def export_tsv(directory: str, filepath: str, batch: int = 10000):
+    """
+    Export a columnar archive to the TSV format
+    """
+    writer = TsvWriter(filepath)
+    for path in list_segments(directory):
+        segment = Segment(path)
+        rows = []
+        for reading in segment.readings():
+            rows.append(reading)
+            if len(rows) >= batch:
+                writer.write(rows)
+                rows = []
+        writer.write(rows)
+        segment.close()
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export columnar archive to TSV')
+    parser.add_argument('--path', help='Directory of the columnar archive', required=True)
+    parser.add_argument('--export', help='Path of the TSV file to write', required=True)
+    args = parser.parse_args()
+
+    export_tsv(args.path, args.export)
@@ -1,72 +1,339 @@
 import argparse
 import asyncio
+import heapq
+import itertools
 import json
 import random
 import os
-import logging
 import socket
-import sys
+import time
+
+import latency
+import logsetup
+import metrics
+import wire
+from archive_store import TsvWriter, ColumnarWriter, BackgroundWriter, MIN_WAIT
+from framing import StreamDecoder
+
+
+TSV = 'tsv'
+COLUMNAR = 'columnar'
+
+STORAGES = [TSV, COLUMNAR]
+
+
+class ReorderBuffer:
+    """
+    Holds readings in a heap keyed by timestamp and releases them in time order.
+
+    A reading is released once it is older than the watermark (current time minus
+    the allowed lateness) or when the buffer is full. Readings arriving with a
+    timestamp before the last released one can no longer be placed in order and
+    are reported as late.
+    """
+
+    def __init__(self, lateness: float = 2., max_size: int = 100000):
+        self.lateness = int(lateness * 1_000_000_000)
+        self.max_size = max_size
+        self.heap = []
+        self.counter = itertools.count()  # keeps arrival order of readings with equal timestamps
+        self.released_ts = 0
+
+    def push(self, reading: wire.Reading) -> bool:
+        """
+        :return: False if the reading is late and was not buffered
+        """
+        if reading.ts < self.released_ts:
+            return False
+        heapq.heappush(self.heap, (reading.ts, next(self.counter), reading))
+        return True
+
+    def pop_ready(self, now: int = None) -> list:
+        """
+        Remove the readings older than the watermark, or over the size limit, in time order
+        """
+        if now is None:
+            now = time.time_ns()
+        watermark = now - self.lateness
+
+        heap = self.heap
+        ready = []
+        while heap and (heap[0][0] <= watermark or len(heap) > self.max_size):
+            ready.append(heapq.heappop(heap)[2])
+
+        if ready:
+            self.released_ts = ready[-1].ts
+        return ready
+
+    def pop_all(self) -> list:
+        ready = [heapq.heappop(self.heap)[2] for _ in range(len(self.heap))]
+        if ready:
+            self.released_ts = ready[-1].ts
+        return ready
 
 
 class Archive(asyncio.Protocol):
 
-    def __init__(self, loop: asyncio.AbstractEventLoop, filepath: str = None):
+    def __init__(self, loop: asyncio.AbstractEventLoop, filepath: str = None, protocol: str = wire.JSON,
+                 lateness: float = 2., reorder_size: int = 100000, storage: str = TSV, fsync_interval: float = 1.,
+                 fsync_rows: int = 10000, rotate_size: int = 0, rotate_interval: float = 0., compress: bool = False,
+                 group: str = None, replicas: int = 1, reconnect_interval: float = 0., latency_interval: float = 10.):
+        """
+        :param group: consumer group sharing the devices with other archives, all devices are archived if None
+        :param replicas: number of archives of the group storing each device
+        :param reconnect_interval: time in seconds between attempts to connect again when the connection is lost,
+                                   0 closes the archive instead
+        :param latency_interval: time in seconds between logs of the latency of every hop, 0 disables
+        """
         self.loop = loop
         self.transport = None
+        self.address = None
+        self.reconnect_interval = reconnect_interval
+        self.closing = False
+        self.protocol = protocol
+        self.group = group
+        self.replicas = replicas
+        self.decoder = StreamDecoder(protocol)
+        self.flush_task = None
+        self.reconnect_task = None
+        self.paused = False  # reading from the server stops while the writers are backlogged
+
+        # Readings are written sorted by time after waiting for the late ones
+        self.reorder = ReorderBuffer(lateness, reorder_size)
+        self.flush_interval = max(lateness / 4, 0.05)
+        self.late_count = 0
+
+        # Latency from the devices through the server to the archive
+        self.latency = latency.HopLatency()
+        self.latency_interval = latency_interval
+        self.latency_task = None
+
+        # Counters served as metrics
+        self.received = 0
+        self.received_bytes = 0
+        self.readings = 0
+        self.sent = 0
+        self.replay_requests = 0
+        self.metrics = metrics.Registry('archive')
+        self.metrics.register(self.collect_metrics)
+        self.metrics.register(self.latency.collect)
+        self.metrics_server = None
+        self.loop_lag_task = None
+
+        # Last sequence number per device, missed readings are replayed by the server
+        self.last_seq = {}
 
         if filepath is None:
-            filepath = f'./archives/archive{random.randint(1, 10000)}.txt'
+            filepath = f'./archives/archive{random.randint(1, 10000)}'
+            if storage == TSV:
+                filepath += '.txt'
         self.filepath = filepath
-
-        # Open file for writing at the start
-        self.file = open(self.filepath, 'a+')
-        if os.stat(self.filepath).st_size == 0:
-            self.file.write('\t'.join(['Timestamp', 'ID', 'Sensor_Type', 'Value']))
-            self.file.write('\n')
+        self.late_filepath = f'{os.path.splitext(filepath)[0]}.late.txt'
+        self.late_file = None
 
         # Initialization of logger
-        self.log = logging.getLogger('Archive')
-        handler = logging.StreamHandler(sys.stdout)
+        self.log = logsetup.get_logger('Archive')
+        self.data_log = logsetup.get_logger('Archive.data', sampled=True)
 
-        # Datetime formatting setup
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
+        # Open file for writing at the start, rows are written by a background thread
+        if storage == COLUMNAR:
+            writer = ColumnarWriter(self.filepath)
+        else:
+            writer = TsvWriter(self.filepath)
+        self.file = BackgroundWriter(writer, self.log, fsync_interval=fsync_interval, fsync_rows=fsync_rows,
+                                     rotate_size=rotate_size, rotate_interval=rotate_interval, compress=compress)
+        self.fsync_interval = fsync_interval
+        self.fsync_rows = fsync_rows
 
-        self.log.addHandler(handler)
-        self.log.setLevel(logging.INFO)
+    async def connect(self, addr: str, port: int):
+        self.address = (addr, port)
+        await self.loop.create_connection(lambda: self, addr, port)
+
+    async def reconnect(self):
+        """
+        Connect again after losing the connection, the readings missed meanwhile are then replayed
+        """
+        while not self.closing:
+            await asyncio.sleep(self.reconnect_interval)
+            try:
+                await self.connect(*self.address)
+                return
+            except OSError as e:
+                self.log.warning(f'Reconnecting failed: {e}')
+
+    def reconnect_done(self, task: asyncio.Task):
+        if self.reconnect_task is task:
+            self.reconnect_task = None
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(f'Reconnecting failed: {task.exception()!r}')
 
     def connection_made(self, transport: asyncio.Transport):
         self.transport = transport
+        self.decoder = StreamDecoder(self.protocol)
+        self.paused = False
+
+        handshake = {
+            'type': 'archive',
+            'protocol': self.protocol
+        }
+        if self.group is not None:
+            handshake.update(group=self.group, replicas=self.replicas)
+        self.send(json.dumps(handshake), wire.JSON)
 
-        self.send(json.dumps({
-            'type': 'archive'
-        }))
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_data())
+        if self.latency_task is None and self.latency_interval > 0:
+            self.latency_task = asyncio.create_task(latency.report(self.latency, self.log, self.latency_interval))
 
         self.log.info('Connection made')
 
     def connection_lost(self, exc):
         self.log.info('Connection lost')
-        self.file.close()  # Close the file when connection is lost
         if exc:
             self.log.error(f'Error: {exc}')
+        if self.reconnect_interval and self.address is not None and not self.closing:
+            if self.reconnect_task is None or self.reconnect_task.done():
+                self.reconnect_task = self.loop.create_task(self.reconnect())
+                self.reconnect_task.add_done_callback(self.reconnect_done)
+        else:
+            self.close()  # Close the file when connection is lost
 
     def data_received(self, data: bytes):
-        data = data.decode('utf-8').strip()
-        data = self.parse_msg(data)
+        received = time.time_ns()
+        self.received_bytes += len(data)
+        try:
+            data = self.parse_msg(data)
+        except ValueError as e:
+            self.log.error(f'Invalid data from the server, closing the connection: {e}')
+            self.transport.close()
+            return
+        self.received += len(data)
+        self.latency.record(data, received)
 
+        late = []
         for row in data:
-            self.file.write('\t'.join([row[0]] + row[1]))
-            self.file.write('\n')
+            if isinstance(row, wire.Reading):
+                self.readings += 1
+                self.check_gap(row)
+                if not self.reorder.push(row):
+                    late.append(row)
+            elif row.startswith(('REPLAYED:', 'ERROR:')):
+                self.log.info(row)
+
+        if late:
+            self.write_late(late)
+        self.write(self.reorder.pop_ready())
+        self.check_backlog()
+
+    def backlogged(self) -> bool:
+        return self.file.backlogged or (self.late_file is not None and self.late_file.backlogged)
+
+    def check_backlog(self):
+        """
+        Stop reading from the server while the disk can't keep up, the server queues the readings meanwhile
+        """
+        if not self.paused and self.backlogged():
+            self.log.warning('Archive writer is behind, pausing reading from the server')
+            self.transport.pause_reading()
+            self.paused = True
+
+    def check_gap(self, row: wire.Reading):
+        """
+        Request the readings between the last received one of the device and this one from the server
+        """
+        if not row.seq:
+            return  # the server does not number the readings
+        last = self.last_seq.get(row.device_id)
+        if last is not None and row.seq > last + 1:
+            self.log.warning(f'Missed readings {last + 1}-{row.seq - 1} of device {row.device_id}, requesting replay')
+            self.send(f'replay {row.device_id} {last + 1} {row.seq - 1}')
+            self.replay_requests += 1
+        if last is None or row.seq > last:
+            self.last_seq[row.device_id] = row.seq
 
-    def parse_msg(self, data):
-        data = data.split('\n')
-        return [json.loads(d) for d in data]
+    def collect_metrics(self, scrape: metrics.Scrape):
+        scrape.counter('messages_in_total', 'Messages received from the server', self.received)
+        scrape.counter('bytes_in_total', 'Bytes received from the server', self.received_bytes)
+        scrape.counter('messages_out_total', 'Messages sent to the server', self.sent)
+        scrape.counter('readings_total', 'Readings received', self.readings)
+        scrape.counter('late_readings_total', 'Readings written to the late file', self.late_count)
+        scrape.counter('replay_requests_total', 'Replays of missed readings requested', self.replay_requests)
+        scrape.gauge('reorder_depth', 'Readings waiting in the reorder buffer', len(self.reorder.heap))
+        scrape.gauge('writer_queue_depth', 'Batches of rows waiting for the writer thread', self.file.queue.qsize())
+        scrape.counter('writer_dropped_rows_total', 'Rows dropped after the writer thread failed', self.file.dropped)
+        scrape.gauge('writer_failed', 'Whether the writer thread failed and rows are dropped',
+                     int(self.file.error is not None))
+        scrape.gauge('devices', 'Devices with received readings', len(self.last_seq))
 
-    def send(self, data: str):
-        data += '\n'
+    async def serve_metrics(self, port: int):
+        """
+        Serve the metrics on a local port and start measuring the delay of the event loop
+        """
+        loop_lag = metrics.LoopLag()
+        self.metrics.register(loop_lag.collect)
+        self.loop_lag_task = asyncio.create_task(loop_lag.run())
+        self.metrics_server = await metrics.serve(self.metrics, port, self.log)
+
+    async def flush_data(self):
+        """
+        Event loop releasing the buffered readings when no new data arrives
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval if not self.paused else MIN_WAIT)
+            self.write(self.reorder.pop_ready())
+            self.file.flush()
+            if self.late_file is not None:
+                self.late_file.flush()
+            if self.paused and not self.backlogged():
+                self.log.info('Archive writer caught up, resuming reading from the server')
+                self.transport.resume_reading()
+                self.paused = False
+
+    def write(self, rows: list):
+        if rows:
+            self.file.write(rows)
+
+    def write_late(self, rows: list):
+        """
+        Write readings that arrived after their place in the archive was already written,
+        with their own background writer and the same group commit as the archive
+        """
+        if self.late_file is None:
+            self.late_file = BackgroundWriter(TsvWriter(self.late_filepath), self.log,
+                                              fsync_interval=self.fsync_interval, fsync_rows=self.fsync_rows)
+        self.late_count += len(rows)
+        self.late_file.write(rows)
+        self.late_file.flush()
+        self.log.warning(f'{len(rows)} late readings written to {self.late_filepath}')
+
+    def close(self):
+        """
+        Write out all the buffered readings and close the files
+        """
+        self.closing = True
+        for task in [self.flush_task, self.latency_task, self.loop_lag_task, self.reconnect_task]:
+            if task is not None:
+                task.cancel()
+        self.flush_task = self.latency_task = self.loop_lag_task = self.reconnect_task = None
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+        if self.file.closed:
+            return
+
+        self.write(self.reorder.pop_all())
+        self.file.close()
+        if self.late_file is not None:
+            self.late_file.close()
+
+    def parse_msg(self, data: bytes):
+        return self.decoder.feed(data)
+
+    def send(self, data: str, protocol: str = None):
         try:
-            self.transport.write(data.encode())
-            self.log.info(f'Sent data {data}')
+            self.transport.write(wire.encode_text(data, protocol or self.protocol))
+            self.sent += 1
+            self.data_log.info('Sent data %s', data)
         except socket.error as e:
             self.log.error(f"Socket error while sending data: {e}")
             self.transport.close()
@@ -76,17 +343,52 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='New archive setup')
     parser.add_argument('--addr', help='Server address', required=False, default='127.0.0.1')
     parser.add_argument('--port', help='Server port', required=False, default=50000)
+    parser.add_argument('--protocol', help='Wire protocol (e.g. json, binary)', required=False, default=wire.JSON,
+                        choices=wire.PROTOCOLS)
+    parser.add_argument('--lateness', help='Time in seconds to wait for late readings before writing them',
+                        required=False, default=2, type=float)
+    parser.add_argument('--reorder_size', help='Maximum number of readings waiting to be sorted', required=False,
+                        default=100000, type=int)
+    parser.add_argument('--storage', help='Archive format (e.g. tsv, columnar)', required=False, default=TSV,
+                        choices=STORAGES)
+    parser.add_argument('--fsync_interval', help='Maximum time in seconds between syncs to disk', required=False,
+                        default=1, type=float)
+    parser.add_argument('--fsync_rows', help='Maximum number of rows between syncs to disk', required=False,
+                        default=10000, type=int)
+    parser.add_argument('--rotate_size', help='Rotate the archive after this many MB (0 disables)', required=False,
+                        default=0, type=float)
+    parser.add_argument('--rotate_interval', help='Rotate the archive after this many seconds (0 disables)',
+                        required=False, default=0, type=float)
+    parser.add_argument('--compress', help='Compress rotated archive files with gzip', action='store_true')
+    parser.add_argument('--group', help='Consumer group sharing the devices between archives', required=False,
+                        default=None)
+    parser.add_argument('--replicas', help='Number of archives of the group storing each device', required=False,
+                        default=1, type=int)
+    parser.add_argument('--reconnect', help='Interval in seconds for reconnecting after the connection is lost '
+                                            '(0 disables)', required=False, default=0, type=float)
+    parser.add_argument('--latency_interval', help='Interval in seconds for logging the latency of every hop of the '
+                                                   'readings (0 disables)', required=False, default=10, type=float)
+    parser.add_argument('--metrics_port', help='Local port serving the metrics (0 disables)', required=False,
+                        default=0, type=int)
+    logsetup.add_arguments(parser)
     args = parser.parse_args()
+
+    logsetup.configure(args.log_format, args.log_rate)
     
     loop = asyncio.get_event_loop()
-    archive = Archive(loop=loop)
-    coro = loop.create_connection(lambda: archive, args.addr, args.port)
-    loop.run_until_complete(coro)
+    archive = Archive(loop=loop, protocol=args.protocol, lateness=args.lateness, reorder_size=args.reorder_size,
+                      storage=args.storage, fsync_interval=args.fsync_interval, fsync_rows=args.fsync_rows,
+                      rotate_size=int(args.rotate_size * 1024 * 1024), rotate_interval=args.rotate_interval,
+                      compress=args.compress, group=args.group, replicas=args.replicas,
+                      reconnect_interval=args.reconnect, latency_interval=args.latency_interval)
+    if args.metrics_port:
+        loop.run_until_complete(archive.serve_metrics(args.metrics_port))
+    loop.run_until_complete(archive.connect(args.addr, args.port))
 
     try:
         loop.run_forever()
     except KeyboardInterrupt as e:
-        archive.file.close()
+        archive.close()
         tasks = [task for task in asyncio.all_tasks(loop) if task is not asyncio.current_task(loop)]
         for task in tasks:
             task.cancel()
@@ -0,0 +1,349 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import logsetup
+import wire
+from framing import StreamDecoder
+from latency import HopLatency, HOPS, TOTAL
+
+
+TYPES = ['temp', 'rad', 'pres', 'hum']
+
+# Distributions of the simulated values
+UNIFORM = 'uniform'  # uniform between 0 and 100
+NORMAL = 'normal'    # normal around 50, mostly in range of the default limits
+WALK = 'walk'        # random walk between 0 and 100, values change slowly like real sensors
+
+DISTRIBUTIONS = [UNIFORM, NORMAL, WALK]
+
+CONSUMERS = ['archive', 'monitor', 'client']
+
+
+class SimDevice(asyncio.Protocol):
+    """
+    Connection of a simulated device, the readings are sent by the DeviceSimulator
+    """
+
+    def __init__(self, device_type: str, protocol: str):
+        self.type = device_type
+        self.protocol = protocol
+        self.transport = None
+        self.seq = 0
+        self.value = 50.
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        transport.write((json.dumps({
+            'type': 'device',
+            'measurement': self.type,
+            'state': 'on',
+            'protocol': self.protocol
+        }) + '\n').encode())
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def data_received(self, data: bytes):
+        pass  # commands of the clients are ignored, the load stays the same
+
+    def send(self, value: float, ts: int):
+        self.seq += 1
+        self.value = value
+        if self.protocol == wire.BINARY:
+            self.transport.write(wire.encode_reading(0, self.seq, ts, value))
+        else:
+            self.transport.write((json.dumps({'seq': self.seq, 'ts': ts, 'value': value}) + '\n').encode())
+
+
+class DeviceSimulator:
+    """
+    Thousands of simulated devices driven by a single task.
+
+    The devices are split into slots that are visited in turn, every tick sends
+    one reading of each device of a slot. The scheduling cost does not grow with
+    the number of devices and the readings are spread evenly over the period.
+    """
+
+    def __init__(self, addr: str, port: int, count: int, rate: float, protocol: str = wire.BINARY,
+                 distribution: str = UNIFORM, seed: int = 0, tick: float = 0.005):
+        """
+        :param rate: readings per second of every device
+        :param tick: shortest interval between two sends of the scheduler
+        """
+        self.addr = addr
+        self.port = port
+        self.rate = rate
+        self.protocol = protocol
+        self.distribution = distribution
+        self.random = random.Random(seed)
+        self.devices = [SimDevice(TYPES[i % len(TYPES)], protocol) for i in range(count)]
+
+        period = 1 / rate
+        self.slots = max(min(count, int(period / tick)), 1)
+        self.tick = period / self.slots
+
+        # Readings sent inside the measured window, set by the caller
+        self.window = (0, 0)
+        self.sent = 0
+        self.late_ticks = 0
+
+    async def connect(self, batch: int = 100):
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(self.devices), batch):
+            await asyncio.gather(*[loop.create_connection(lambda device=device: device, self.addr, self.port)
+                                   for device in self.devices[start:start + batch]])
+
+    def next_value(self, device: SimDevice) -> float:
+        if self.distribution == NORMAL:
+            return self.random.gauss(50., 15.)
+        if self.distribution == WALK:
+            return min(max(device.value + self.random.gauss(0., 2.), 0.), 100.)
+        return self.random.uniform(0., 100.)
+
+    async def run(self):
+        """
+        Send the readings until cancelled, ticks are scheduled on absolute times so the rate does not drift
+        """
+        start = time.monotonic()
+        slots = [self.devices[i::self.slots] for i in range(self.slots)]
+        tick = 0
+        while True:
+            ts = time.time_ns()
+            for device in slots[tick % self.slots]:
+                if device.transport is not None:
+                    device.send(self.next_value(device), ts)
+                    if self.window[0] <= ts < self.window[1]:
+                        self.sent += 1
+
+            tick += 1
+            delay = start + tick * self.tick - time.monotonic()
+            if delay < 0:
+                self.late_ticks += 1
+            await asyncio.sleep(max(delay, 0))
+
+    def close(self):
+        for device in self.devices:
+            if device.transport is not None:
+                device.transport.close()
+
+
+class Probe(asyncio.Protocol):
+    """
+    Instrumented consumer connected as an archive, monitor or client.
+
+    Counts the readings received in the measured window, the readings missing
+    from the sequence of every device and the latency of every hop from the device.
+    """
+
+    def __init__(self, conn_type: str, protocol: str):
+        self.type = conn_type
+        self.protocol = protocol
+        self.decoder = StreamDecoder(protocol)
+        self.transport = None
+        self.window = (0, 0)
+        self.received = 0
+        self.missing = 0
+        self.last_seq = {}
+        self.latency = HopLatency()
+        self.stats = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        transport.write((json.dumps({'type': self.type, 'protocol': self.protocol}) + '\n').encode())
+
+    def data_received(self, data: bytes):
+        now = time.time_ns()
+        measured = []
+        for row in self.decoder.feed(data):
+            if isinstance(row, wire.Reading):
+                last = self.last_seq.get(row.device_id)
+                if last is not None and row.seq > last + 1:
+                    self.missing += row.seq - last - 1
+                if last is None or row.seq > last:
+                    self.last_seq[row.device_id] = row.seq
+                if self.window[0] <= row.ts < self.window[1]:
+                    self.received += 1
+                    measured.append(row)
+            elif row.startswith('STATS: '):
+                self.stats = json.loads(row[len('STATS: '):])
+        self.latency.record(measured, now)
+
+    def request_stats(self):
+        self.transport.write(wire.encode_text('stats', self.protocol))
+
+    def result(self) -> dict:
+        return {'type': self.type, 'received': self.received, 'missing': self.missing,
+                'latency': self.latency.to_dict()}
+
+
+def run_probes(args: argparse.Namespace, conn):
+    """
+    Consumers run in their own process, so receiving does not compete with sending in one event loop
+    """
+    async def measure():
+        loop = asyncio.get_running_loop()
+        probes = []
+        for conn_type in CONSUMERS:
+            for _ in range(getattr(args, f'{conn_type}s')):
+                probe = Probe(conn_type, args.protocol)
+                await loop.create_connection(lambda probe=probe: probe, args.addr, args.port)
+                probes.append(probe)
+        conn.send('ready')
+
+        window = await loop.run_in_executor(None, conn.recv)
+        for probe in probes:
+            probe.window = window
+        await asyncio.sleep(max((window[1] - time.time_ns()) / 1_000_000_000, 0) + args.settle)
+
+        # The drop counters of the server are requested through a client
+        stats = {}
+        clients = [probe for probe in probes if probe.type == 'client']
+        if clients:
+            clients[0].request_stats()
+            await asyncio.sleep(0.5)
+            stats = clients[0].stats or {}
+        conn.send({'probes': [probe.result() for probe in probes], 'server': stats})
+
+    asyncio.run(measure())
+
+
+def start_server(args: argparse.Namespace) -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, 'aggr_server.py', '--port', str(args.port), '--log_rate', '0',
+                               *args.server_args.split()], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.addr, args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'Server did not start on port {args.port}')
+
+
+def report(args: argparse.Namespace, simulator: DeviceSimulator, results: dict) -> dict:
+    """
+    Throughput, losses and latency percentiles of every hop (in milliseconds) per consumer type
+    """
+    summary = {
+        'devices': len(simulator.devices),
+        'rate': args.rate,
+        'protocol': args.protocol,
+        'distribution': args.distribution,
+        'duration': args.duration,
+        'sent': simulator.sent,
+        'sent_per_second': simulator.sent / args.duration,
+        'late_ticks': simulator.late_ticks,
+        'consumers': {}
+    }
+    for conn_type in CONSUMERS:
+        probes = [probe for probe in results['probes'] if probe['type'] == conn_type]
+        if not probes:
+            continue
+        latency = HopLatency()
+        for probe in probes:
+            latency.merge(HopLatency.from_dict(probe['latency']))
+        received = sum(probe['received'] for probe in probes)
+        summary['consumers'][conn_type] = {
+            'connections': len(probes),
+            'received': received,
+            'received_per_second': received / args.duration,
+            'delivered': received / (simulator.sent * len(probes)) if simulator.sent else 0.,
+            'missing': sum(probe['missing'] for probe in probes),
+            'server_dropped': sum(sub['dropped'] for sub in results['server'].values() if sub['type'] == conn_type),
+            'latency_ms': latency.summary(1_000_000)
+        }
+    return summary
+
+
+def print_report(summary: dict):
+    print(f'{summary["devices"]} devices x {summary["rate"]:g}/s ({summary["protocol"]}, {summary["distribution"]}): '
+          f'{summary["sent"]} readings sent in {summary["duration"]:g} s '
+          f'({summary["sent_per_second"]:.0f}/s, late ticks: {summary["late_ticks"]})')
+    print('\t'.join(['consumer', 'received/s', 'delivered', 'missing', 'dropped', 'p50 ms', 'p99 ms', 'p999 ms',
+                     'max ms']))
+    for conn_type, result in summary['consumers'].items():
+        latency = result['latency_ms'][TOTAL]
+        print('\t'.join([f'{conn_type} x{result["connections"]}', f'{result["received_per_second"]:.0f}',
+                         f'{result["delivered"]:.2%}', str(result['missing']), str(result['server_dropped'])] +
+                        [f'{latency[key]:.2f}' if key in latency else 'n/a' for key in ['p50', 'p99', 'p999', 'max']]))
+
+    print()
+    print('\t'.join(['hop', 'consumer', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms']))
+    for hop in HOPS:
+        for conn_type, result in summary['consumers'].items():
+            latency = result['latency_ms'][hop]
+            print('\t'.join([hop, conn_type] + [f'{latency[key]:.2f}' if key in latency else 'n/a'
+                                                for key in ['p50', 'p99', 'p999', 'max']]))
+
+
+async def run_devices(args: argparse.Namespace, conn) -> DeviceSimulator:
+    simulator = DeviceSimulator(args.addr, args.port, args.devices, args.rate, args.protocol, args.distribution,
+                                args.seed)
+    await simulator.connect()
+    task = asyncio.create_task(simulator.run())
+
+    start = time.time_ns() + int(args.warmup * 1_000_000_000)
+    simulator.window = (start, start + int(args.duration * 1_000_000_000))
+    conn.send(simulator.window)
+    await asyncio.sleep(args.warmup + args.duration)
+
+    task.cancel()
+    simulator.close()
+    return simulator
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load and latency benchmark of the server')
+    parser.add_argument('--addr', help='Server address', required=False, default='127.0.0.1')
+    parser.add_argument('--port', help='Server port', required=False, default=50000, type=int)
+    parser.add_argument('--start_server', help='Start a server for the benchmark and stop it afterwards',
+                        required=False, action='store_true')
+    parser.add_argument('--server_args', help='Arguments of the started server (e.g. "--workers 2")',
+                        required=False, default='')
+    parser.add_argument('--protocol', help='Wire protocol (e.g. json, binary)', required=False, default=wire.BINARY,
+                        choices=wire.PROTOCOLS)
+    parser.add_argument('--devices', help='Number of simulated devices', required=False, default=1000, type=int)
+    parser.add_argument('--rate', help='Readings per second of every device', required=False, default=1, type=float)
+    parser.add_argument('--distribution', help='Distribution of the values', required=False, default=UNIFORM,
+                        choices=DISTRIBUTIONS)
+    parser.add_argument('--seed', help='Seed of the simulated values', required=False, default=0, type=int)
+    parser.add_argument('--archives', help='Number of archive consumers', required=False, default=1, type=int)
+    parser.add_argument('--monitors', help='Number of monitor consumers', required=False, default=1, type=int)
+    parser.add_argument('--clients', help='Number of client consumers', required=False, default=1, type=int)
+    parser.add_argument('--warmup', help='Seconds before the measurement starts', required=False, default=2,
+                        type=float)
+    parser.add_argument('--duration', help='Seconds of measurement', required=False, default=10, type=float)
+    parser.add_argument('--settle', help='Seconds to wait for the readings still in flight', required=False,
+                        default=1, type=float)
+    parser.add_argument('--output', help='Write the results as JSON to this file', required=False, default=None)
+    args = parser.parse_args()
+
+    logsetup.configure()
+    server = start_server(args) if args.start_server else None
+
+    parent, child = multiprocessing.Pipe()
+    probes = multiprocessing.get_context('fork').Process(target=run_probes, args=(args, child))
+    probes.start()
+    try:
+        parent.recv()  # consumers are connected before the devices so they see every reading
+        simulator = asyncio.run(run_devices(args, parent))
+        summary = report(args, simulator, parent.recv())
+        print_report(summary)
+        if args.output is not None:
+            with open(args.output, 'w') as file:
+                json.dump(summary, file, indent=2)
+    finally:
+        probes.join(5)
+        if probes.is_alive():
+            probes.kill()
+        if server is not None:
+            server.terminate()
+            server.wait()
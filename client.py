@@ -3,35 +3,75 @@ import asyncio
 import json
 import logging
 import socket
-import sys
+import time
+
+import latency
+import logsetup
+import wire
+from client_view import ClientView, ViewLogHandler
+from framing import StreamDecoder
 
 
 class Client(asyncio.Protocol):
 
-    def __init__(self, loop: asyncio.AbstractEventLoop):
+    def __init__(self, loop: asyncio.AbstractEventLoop, protocol: str = wire.JSON, subscribe: dict = None,
+                 status: bool = False, view: bool = False, fps: float = 4., latency_interval: float = 10.):
+        """
+        :param subscribe: readings to receive, e.g. {'types': ['rad'], 'devices': [...]} or {'alarms_only': True},
+                          everything if None
+        :param status: only query the current values and alarms once instead of receiving the stream
+        :param view: show the latest value of every device in a full-screen view redrawn `fps` times per second
+                     instead of printing every message
+        :param latency_interval: time in seconds between logs of the latency of every hop, 0 disables
+        """
         self.loop = loop
         self.transport = None
         self.send_task = None
-
-        # Initialization of logger
-        self.log = logging.getLogger('Client')
-        handler = logging.StreamHandler(sys.stdout)
-
-        # Datetime formatting setup
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-
-        self.log.addHandler(handler)
-        self.log.setLevel(logging.INFO)
+        self.protocol = protocol
+        self.subscribe = subscribe
+        self.status = status
+        self.decoder = StreamDecoder(protocol)
+        self.view = ClientView(self.send, fps) if view else None
+
+        # Latency from the devices through the server to the client
+        self.latency = latency.HopLatency()
+        self.latency_interval = latency_interval
+        self.latency_task = None
+
+        # Initialization of logger, the view shows the records itself instead of the shared output
+        self.log = logsetup.get_logger('Client')
+        self.data_log = logsetup.get_logger('Client.data', sampled=True)
+        if self.view is not None:
+            handler = ViewLogHandler(self.view)
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            self.log.addHandler(handler)
+            self.log.setLevel(logging.WARNING)
+            self.log.propagate = False
 
     def connection_made(self, transport: asyncio.Transport):
         self.transport = transport
 
-        self.send(json.dumps({
-            'type': 'client'
-        }))
-
-        self.send_task = asyncio.create_task(self.send_data())
+        handshake = {
+            'type': 'client',
+            'protocol': self.protocol
+        }
+        if self.status:
+            handshake['type'] = 'status'
+            if self.subscribe is not None and self.subscribe.get('types'):
+                handshake['measurement'] = self.subscribe['types'][0]
+            self.send(json.dumps(handshake), wire.JSON)
+            return
+
+        if self.subscribe is not None:
+            handshake['subscribe'] = self.subscribe
+        self.send(json.dumps(handshake), wire.JSON)
+
+        if self.view is not None:
+            self.view.start()
+        else:
+            self.send_task = asyncio.create_task(self.send_data())
+        if self.latency_interval > 0:
+            self.latency_task = asyncio.create_task(latency.report(self.latency, self.log, self.latency_interval))
 
         self.log.info('Connection made')
 
@@ -39,23 +79,51 @@ class Client(asyncio.Protocol):
         self.log.info('Connection lost')
         if exc:
             self.log.error(f'Error: {exc}')
+        if self.view is not None:
+            self.view.messages.append('Connection lost')
+        if self.latency_task is not None:
+            self.latency_task.cancel()
+        if self.status:
+            self.loop.stop()
 
     def data_received(self, data: bytes):
-        self.log.info('Data received')
-        data = data.decode('utf-8').strip()
-        data = data.split('\n')
-
-        for d in data:
-            try:
-                json_obj = json.loads(d)
-
-                print(json_obj[0])
-                for row in json_obj[1:]:
-                    print('\t'.join(row))
-                print()
-            except ValueError as e:
-                print(d)
-                print()
+        received = time.time_ns()
+        self.data_log.info('Data received')
+        try:
+            rows = self.decoder.feed(data)
+        except ValueError as e:
+            self.log.error(f'Invalid data from the server, closing the connection: {e}')
+            self.transport.close()
+            return
+        self.latency.record(rows, received)
+        if self.view is not None:
+            self.view.update(rows)
+        else:
+            self.display(rows)
+
+    def display(self, data: list):
+        for row in data:
+            if isinstance(row, wire.Reading):
+                print(wire.format_time(row.ts))
+                print('\t'.join([row.device_id, row.sensor_type, repr(row.value)]))
+            elif row.startswith('AGGREGATE: '):
+                self.display_aggregate(json.loads(row[len('AGGREGATE: '):]))
+            else:
+                print(row)
+            print()
+
+    @staticmethod
+    def display_aggregate(aggregate: dict):
+        """
+        Print the aggregates of a window as a table per sensor type and device
+        """
+        print(f'{aggregate["start"]} ({aggregate["interval"]:g} s)')
+        print('\t'.join(['name', 'count', 'min', 'max', 'mean', 'last']))
+        rows = [(sensor_type, values) for sensor_type, values in sorted(aggregate['types'].items())]
+        rows += [(device_id, values) for device_id, values in sorted(aggregate['devices'].items())]
+        for name, values in rows:
+            print('\t'.join([name, str(values['count'])] +
+                            [f'{values[field]:.3f}' for field in ['min', 'max', 'mean', 'last']]))
 
     async def send_data(self):
         """
@@ -65,10 +133,9 @@ class Client(asyncio.Protocol):
             data = await self.loop.run_in_executor(None, input, ">")
             self.send(data)
 
-    def send(self, data: str):
-        data += '\n'
+    def send(self, data: str, protocol: str = None):
         try:
-            self.transport.write(data.encode())
+            self.transport.write(wire.encode_text(data, protocol or self.protocol))
         except socket.error as e:
             self.log.error(f"Socket error while sending data: {e}")
             self.transport.close()
@@ -78,16 +145,45 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='New client setup')
     parser.add_argument('--addr', help='Server address', required=False, default='127.0.0.1')
     parser.add_argument('--port', help='Server port', required=False, default=50000)
+    parser.add_argument('--protocol', help='Wire protocol (e.g. json, binary)', required=False, default=wire.JSON,
+                        choices=wire.PROTOCOLS)
+    parser.add_argument('--type', help='Sensor type to receive, can be repeated', required=False, action='append')
+    parser.add_argument('--device', help='Device ID to receive, can be repeated', required=False, action='append')
+    parser.add_argument('--alarms_only', help='Receive only alarms and no readings', required=False,
+                        action='store_true')
+    parser.add_argument('--aggregate', help='Receive the aggregates over windows of this many seconds instead of '
+                                            'the readings', required=False, default=None, type=float)
+    parser.add_argument('--view', help='Full-screen view of the latest values instead of printing every message',
+                        required=False, action='store_true')
+    parser.add_argument('--fps', help='Redraws per second of the view', required=False, default=4, type=float)
+    parser.add_argument('--status', help='Print the current values and alarms and exit', required=False,
+                        action='store_true')
+    parser.add_argument('--latency_interval', help='Interval in seconds for logging the latency of every hop of the '
+                                                   'readings (0 disables)', required=False, default=10, type=float)
+    logsetup.add_arguments(parser)
     args = parser.parse_args()
+
+    logsetup.configure(args.log_format, args.log_rate)
+
+    subscribe = None
+    if args.alarms_only:
+        subscribe = {'alarms_only': True}
+    elif args.type or args.device or args.aggregate:
+        subscribe = {'types': args.type or [], 'devices': args.device or []}
+        if args.aggregate:
+            subscribe['aggregate'] = args.aggregate
     
     loop = asyncio.get_event_loop()
-    client = Client(loop=loop)
+    client = Client(loop=loop, protocol=args.protocol, subscribe=subscribe, status=args.status, view=args.view,
+                    fps=args.fps, latency_interval=args.latency_interval)
     coro = loop.create_connection(lambda: client, args.addr, args.port)
     loop.run_until_complete(coro)
 
     try:
         loop.run_forever()
     except KeyboardInterrupt as e:
+        if client.view is not None:
+            client.view.stop()
         tasks = [task for task in asyncio.all_tasks(loop) if task is not asyncio.current_task(loop)]
         for task in tasks:
             task.cancel()
@@ -0,0 +1,155 @@
+import asyncio
+import collections
+import curses
+import logging
+import time
+
+import wire
+from lastvalue import parse_alarm, CLEARED
+
+
+ENTER = (10, 13, curses.KEY_ENTER)
+BACKSPACE = (8, 127, curses.KEY_BACKSPACE)
+
+
+class ViewLogHandler(logging.Handler):
+    """
+    Shows the log records of the client in the message area instead of printing over the screen
+    """
+
+    def __init__(self, view: 'ClientView'):
+        super().__init__()
+        self.view = view
+
+    def emit(self, record: logging.LogRecord):
+        self.view.messages.append(self.format(record))
+
+
+class ClientView:
+    """
+    Full-screen view of the latest value of every device, the active alarms and an input line.
+
+    Received readings only replace the latest value of their device and the
+    screen is redrawn at a fixed frame rate, so the cost of the view does not
+    depend on how fast the devices report.
+    """
+
+    def __init__(self, on_command, fps: float = 4., max_alarms: int = 8, max_messages: int = 3):
+        """
+        :param on_command: function called with every line entered by the user
+        """
+        self.on_command = on_command
+        self.interval = 1 / fps
+        self.latest = {}  # device id -> Reading
+        self.alarms = collections.OrderedDict()  # alarm key -> message, alarms without a key by message
+        self.max_alarms = max_alarms
+        self.messages = collections.deque(maxlen=max_messages)
+        self.received = 0
+        self.rate = 0.
+        self.input = ''
+        self.screen = None
+        self.draw_task = None
+
+    def update(self, rows: list):
+        for row in rows:
+            if isinstance(row, wire.Reading):
+                self.latest[row.device_id] = row
+                self.received += 1
+            elif row.startswith('ALARM: '):
+                self.add_alarm(row)
+            elif row:
+                self.messages.append(row)
+
+    def add_alarm(self, alarm: str):
+        parsed = parse_alarm(alarm)
+        key = alarm if parsed is None else parsed[0]
+        self.alarms.pop(key, None)
+        if parsed is None or parsed[1] != CLEARED:
+            self.alarms[key] = alarm
+        while len(self.alarms) > self.max_alarms:
+            self.alarms.popitem(last=False)
+
+    def start(self):
+        self.screen = curses.initscr()
+        curses.noecho()
+        curses.cbreak()
+        self.screen.keypad(True)
+        self.screen.nodelay(True)
+        self.draw_task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.draw_task is not None:
+            self.draw_task.cancel()
+            self.draw_task = None
+        if self.screen is not None:
+            self.screen.keypad(False)
+            curses.nocbreak()
+            curses.echo()
+            curses.endwin()
+            self.screen = None
+
+    async def run(self):
+        """
+        Event loop reading the keys and redrawing the screen
+        """
+        last, received = time.monotonic(), 0
+        while True:
+            self.read_keys()
+            now = time.monotonic()
+            if now - last >= 1:
+                self.rate = (self.received - received) / (now - last)
+                last, received = now, self.received
+            self.draw()
+            await asyncio.sleep(self.interval)
+
+    def read_keys(self):
+        while True:
+            key = self.screen.getch()
+            if key == -1:
+                return
+            if key in ENTER:
+                line, self.input = self.input.strip(), ''
+                if line:
+                    self.on_command(line)
+            elif key in BACKSPACE:
+                self.input = self.input[:-1]
+            elif 32 <= key < 127:
+                self.input += chr(key)
+
+    def draw(self):
+        height, width = self.screen.getmaxyx()
+        self.screen.erase()
+
+        self.write(0, f'Devices: {len(self.latest)}  Readings: {self.received} ({self.rate:.0f}/s)  '
+                      f'Alarms: {len(self.alarms)}', width, curses.A_REVERSE)
+        self.write(1, f'{"ID":<38}{"TYPE":<8}{"VALUE":>12}  {"TIME":<21}{"SEQ":>8}', width, curses.A_BOLD)
+
+        # Devices take the lines left by the alarms, messages and input line
+        footer = len(self.alarms) + len(self.messages) + 2
+        rows = sorted(self.latest.items(), key=lambda item: (item[1].sensor_type, item[0]))
+        for line, (device_id, reading) in enumerate(rows[:max(height - footer - 2, 0)], 2):
+            self.write(line, f'{device_id:<38}{reading.sensor_type:<8}{reading.value:>12.3f}  '
+                             f'{wire.format_time(reading.ts):<21}{reading.seq:>8}', width)
+
+        line = height - footer
+        self.write(line, 'Alarms', width, curses.A_BOLD)
+        for alarm in self.alarms.values():
+            line += 1
+            self.write(line, alarm, width)
+        for message in self.messages:
+            line += 1
+            self.write(line, message, width)
+        self.write(height - 1, f'> {self.input}', width)
+        try:
+            self.screen.move(height - 1, min(len(self.input) + 2, width - 1))
+        except curses.error:
+            pass
+        self.screen.refresh()
+
+    def write(self, line: int, text: str, width: int, attr: int = 0):
+        if line < 0:
+            return
+        try:
+            self.screen.addnstr(line, 0, text, width - 1, attr)
+        except curses.error:
+            pass  # line outside of a resized screen
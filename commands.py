@@ -0,0 +1,85 @@
+STATES = ['on', 'off']
+
+# Targets of a command
+TYPE = 'type'
+DEVICE = 'device'
+
+
+class PendingCommand:
+    """
+    State change sent to devices, waiting for their acknowledgements
+    """
+    __slots__ = ['id', 'sub', 'kind', 'target', 'state', 'expected', 'unacknowledged', 'acked', 'timer']
+
+    def __init__(self, command_id: int, sub, kind: str, target: str, state: str, expected: set,
+                 unacknowledged: int = 0):
+        self.id = command_id
+        self.sub = sub  # subscriber of the client that issued the command
+        self.kind = kind
+        self.target = target
+        self.state = state
+        self.expected = expected  # IDs of the devices the command was sent to with its ID
+        self.unacknowledged = unacknowledged  # devices sent only the state, they do not acknowledge commands
+        self.acked = set()
+        self.timer = None
+
+    def result(self) -> dict:
+        return {
+            'command': self.id,
+            'target': self.kind,
+            'id': self.target,
+            'state': self.state,
+            'devices': len(self.expected) + self.unacknowledged,
+            'acked': len(self.acked),
+            'missing': sorted(self.expected - self.acked),
+            'unacknowledged': self.unacknowledged
+        }
+
+
+class CommandTracker:
+    """
+    Commands waiting for the acknowledgements of their devices, by command ID.
+
+    Every worker numbers its commands with its own stride like the device
+    handles, so the acknowledgements of devices connected to other workers can
+    be matched without coordinating the IDs.
+    """
+
+    def __init__(self, worker: int = 0, workers: int = 1):
+        self.workers = workers
+        self.next_id = worker + 1
+        self.pending = {}
+
+    def add(self, sub, kind: str, target: str, state: str, expected: set, unacknowledged: int = 0) -> PendingCommand:
+        command = PendingCommand(self.next_id, sub, kind, target, state, expected, unacknowledged)
+        self.next_id += self.workers
+        self.pending[command.id] = command
+        return command
+
+    def ack(self, command_id: int, device_id: str, state: str) -> bool:
+        """
+        :return: True if the command of this worker got the acknowledgements of all its devices
+        """
+        command = self.pending.get(command_id)
+        if command is None or device_id not in command.expected or state != command.state:
+            return False
+        command.acked.add(device_id)
+        return len(command.acked) == len(command.expected)
+
+    def pop(self, command_id: int):
+        return self.pending.pop(command_id, None)
+
+
+def parse_ack(message: str):
+    """
+    Acknowledgement 'ACK: <command id> <state>' sent by a device after a state change
+
+    :return: (command id, state) or None
+    """
+    parts = message.split()
+    if len(parts) != 3 or parts[0] != 'ACK:' or parts[2] not in STATES:
+        return None
+    try:
+        return int(parts[1]), parts[2]
+    except ValueError:
+        return None
@@ -0,0 +1,128 @@
+FACILITY = 'FACILITY'
+SENSOR_FAULT = 'SENSOR_FAULT'
+
+
+class RingCounter:
+    """
+    Number of distinct devices with an event in the last `size` time buckets.
+
+    Every device is only counted in the bucket of its latest event, so the
+    distinct count is the sum of a fixed size ring and needs no rescanning.
+    """
+    __slots__ = ['size', 'counts', 'buckets', 'last']
+
+    def __init__(self, size: int):
+        self.size = size
+        self.counts = [0] * size
+        self.buckets = [-1] * size  # bucket held by every slot of the ring
+        self.last = {}  # device id -> bucket of its latest event
+
+    def slot(self, bucket: int) -> int:
+        slot = bucket % self.size
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.counts[slot] = 0
+        return slot
+
+    def add(self, device_id: str, bucket: int):
+        previous = self.last.get(device_id)
+        if previous is not None:
+            if previous >= bucket:
+                return
+            slot = previous % self.size
+            if self.buckets[slot] == previous:
+                self.counts[slot] -= 1
+        self.counts[self.slot(bucket)] += 1
+        self.last[device_id] = bucket
+
+    def count(self, bucket: int) -> int:
+        oldest = bucket - self.size
+        return sum(count for count, slot_bucket in zip(self.counts, self.buckets) if oldest < slot_bucket <= bucket)
+
+
+class TypeWindow:
+    """
+    Sliding window of the devices of one sensor type that reported, and the ones currently out of range
+    """
+    __slots__ = ['seen', 'breached', 'latest', 'facility', 'faults']
+
+    def __init__(self, size: int):
+        self.seen = RingCounter(size)
+        self.breached = set()  # devices whose latest reading is out of range
+        self.latest = 0  # newest bucket with a reading
+        self.facility = False
+        self.faults = {}  # device id -> bucket of the last fault alarm
+
+
+class Correlation:
+    """
+    Tells a faulty device apart from an emergency affecting all the sensors of a type.
+
+    While at least a quorum of the devices of a type that reported within the
+    window are out of range a FACILITY alarm is reported, while a device that is
+    out of range on its own among enough peers in range raises a SENSOR_FAULT.
+    A device counts as out of range only while its latest reading is, so single
+    spikes of different devices within the window do not add up.
+    """
+
+    def __init__(self, bucket: float = 1., window: int = 10, quorum: float = 0.5, min_devices: int = 3,
+                 min_peers: int = 2):
+        self.bucket = max(int(bucket * 1_000_000_000), 1)
+        self.window = window
+        self.quorum = quorum
+        self.min_devices = min_devices
+        self.min_peers = min_peers
+        self.types = {}
+
+    def update(self, readings: list, breaches: list) -> list:
+        """
+        :param readings: batch of received readings
+        :param breaches: readings of the batch that are out of range
+        :return: list of (alarm kind, sensor type, reading or None, detail)
+        """
+        breaching = set(map(id, breaches))
+        checked = set()
+        for reading in readings:
+            window = self.types.get(reading.sensor_type)
+            if window is None:
+                window = self.types[reading.sensor_type] = TypeWindow(self.window)
+            bucket = reading.ts // self.bucket
+            window.seen.add(reading.device_id, bucket)
+            window.latest = max(window.latest, bucket)
+            if id(reading) in breaching:
+                window.breached.add(reading.device_id)
+                checked.add(reading.sensor_type)
+            else:
+                window.breached.discard(reading.device_id)
+
+        # Types with new breaches or an ongoing facility alarm are checked against the quorum
+        alarms = []
+        counts = {}
+        for sensor_type, window in self.types.items():
+            if sensor_type not in checked and not window.facility:
+                continue
+
+            # Devices that stopped reporting while out of range leave with the window
+            oldest = window.latest - self.window
+            window.breached = {device_id for device_id in window.breached if window.seen.last[device_id] > oldest}
+            seen = window.seen.count(window.latest)
+            breached = len(window.breached)
+            counts[sensor_type] = seen, breached
+            window.facility = breached >= self.min_devices and breached >= self.quorum * seen
+            if window.facility:
+                alarms.append((FACILITY, sensor_type, None, f'Devices out of range: {breached}/{seen}'))
+
+        # A device alone out of range among peers in range is probably faulty
+        for reading in breaches:
+            seen, breached = counts[reading.sensor_type]
+            window = self.types[reading.sensor_type]
+            if breached != 1 or seen - breached < self.min_peers:
+                continue
+
+            bucket = reading.ts // self.bucket
+            last_alarm = window.faults.get(reading.device_id)
+            if last_alarm is None or last_alarm <= bucket - self.window:
+                window.faults[reading.device_id] = bucket
+                alarms.append((SENSOR_FAULT, reading.sensor_type, reading, f'Peers in range: {seen - 1}'))
+
+        return alarms
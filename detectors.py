@@ -0,0 +1,109 @@
+import math
+
+import wire
+
+
+ZSCORE = 'zscore'
+RATE = 'rate'
+STUCK = 'stuck'
+
+DESCRIPTIONS = {
+    ZSCORE: 'Value deviates from its mean',
+    RATE: 'Value changes too fast',
+    STUCK: 'Value is stuck'
+}
+
+
+class DetectorConfig:
+    """
+    Settings of the anomaly detectors of one sensor type, a missing setting disables its detector
+    """
+    __slots__ = ['alpha', 'warmup', 'z_limit', 'max_rate', 'stuck_samples', 'stuck_tolerance']
+
+    def __init__(self, alpha: float = 0.05, warmup: int = 20, z_limit: float = None, max_rate: float = None,
+                 stuck_samples: int = None, stuck_tolerance: float = 0.):
+        self.alpha = alpha
+        self.warmup = warmup
+        self.z_limit = z_limit
+        self.max_rate = max_rate
+        self.stuck_samples = stuck_samples
+        self.stuck_tolerance = stuck_tolerance
+
+
+class DeviceState:
+    """
+    Fixed size state of one device updated in O(1) per sample
+    """
+    __slots__ = ['count', 'mean', 'var', 'last_value', 'last_ts', 'stuck']
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.var = 0.
+        self.last_value = None
+        self.last_ts = None
+        self.stuck = 0
+
+
+class Detectors:
+    """
+    Online anomaly detection per device: EWMA z-score, rate of change and stuck values
+    """
+
+    def __init__(self, config: dict = None):
+        self.types = {}
+        self.devices = {}
+        self.configure(config or {})
+
+    def configure(self, config: dict):
+        """
+        :param config: detector settings per sensor type, the state of the devices is kept
+        """
+        self.types = {sensor_type: DetectorConfig(**settings) for sensor_type, settings in config.items()}
+
+    def update(self, reading: wire.Reading) -> list:
+        """
+        Update the state of the device with a new sample
+
+        :return: list of (detector, detail) for the detectors that fired
+        """
+        config = self.types.get(reading.sensor_type)
+        if config is None:
+            return []
+
+        state = self.devices.get(reading.device_id)
+        if state is None:
+            state = self.devices[reading.device_id] = DeviceState()
+
+        value = reading.value
+        result = []
+
+        if config.z_limit is not None and state.count >= config.warmup and state.var > 0:
+            score = (value - state.mean) / math.sqrt(state.var)
+            if abs(score) > config.z_limit:
+                result.append((ZSCORE, f'Z-score: {score:.2f}'))
+
+        if state.last_value is not None:
+            delta = abs(value - state.last_value)
+            if config.max_rate is not None and reading.ts > state.last_ts:
+                rate = delta / ((reading.ts - state.last_ts) / 1_000_000_000)
+                if rate > config.max_rate:
+                    result.append((RATE, f'Rate: {rate:.2f}/s'))
+
+            state.stuck = state.stuck + 1 if delta <= config.stuck_tolerance else 0
+            # Fires on every sample while stuck, the alarm tracker only notifies the changes
+            if config.stuck_samples is not None and state.stuck >= config.stuck_samples:
+                result.append((STUCK, f'Samples: {state.stuck + 1}'))
+
+        # Exponentially weighted mean and variance
+        if state.count == 0:
+            state.mean = value
+        else:
+            diff = value - state.mean
+            increment = config.alpha * diff
+            state.mean += increment
+            state.var = (1 - config.alpha) * (state.var + diff * increment)
+        state.count += 1
+        state.last_value = value
+        state.last_ts = reading.ts
+        return result
@@ -1,33 +1,33 @@
 import argparse
 import asyncio
-import logging
 import random
 import json
 import socket
-import sys
+import time
+
+import logsetup
+import wire
+from framing import StreamDecoder
 
 
 class Device(asyncio.Protocol):
 
-    def __init__(self, device_type: str, state: str, rate: float, loop: asyncio.AbstractEventLoop):
+    def __init__(self, device_type: str, state: str, rate: float, loop: asyncio.AbstractEventLoop,
+                 protocol: str = wire.JSON):
         self.type = device_type
         self.rate = rate
         self.state = state
         self.loop = loop
+        self.protocol = protocol
         
         self.send_task = None
         self.transport = None
+        self.decoder = StreamDecoder(protocol)
+        self.seq = 0
 
-        # Initialization of logger
-        self.log = logging.getLogger('Device')
-        handler = logging.StreamHandler(sys.stdout)
-
-        # Datetime formatting setup
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-
-        self.log.addHandler(handler)
-        self.log.setLevel(logging.INFO)
+        # Initialization of logger, shared by all the devices of the process
+        self.log = logsetup.get_logger('Device')
+        self.data_log = logsetup.get_logger('Device.data', sampled=True)
 
     def connection_made(self, transport: asyncio.Transport):
         self.transport = transport
@@ -35,7 +35,9 @@ class Device(asyncio.Protocol):
         self.send(json.dumps({
             'type': 'device',
             'measurement': self.type,
-            'state': self.state
+            'state': self.state,
+            'protocol': self.protocol,
+            'ack': True  # commands are sent with an ID to acknowledge
         }))
 
         if self.state == 'on':
@@ -51,14 +53,24 @@ class Device(asyncio.Protocol):
 
     def data_received(self, data: bytes):
         self.log.info('Data received')
-        data = data.decode('utf-8').strip()
-        self.change_state(data)
+        try:
+            commands = self.decoder.feed(data)
+        except ValueError as e:
+            self.log.error(f'Invalid data from the server, closing the connection: {e}')
+            self.transport.close()
+            return
+        for command in commands:
+            if isinstance(command, str) and command.strip():
+                # Commands are '<state>' or '<state> <command id>' when the server waits for an acknowledgement
+                parts = command.split()
+                self.change_state(parts[0], parts[1] if len(parts) > 1 else None)
 
-    def change_state(self, state: str):
+    def change_state(self, state: str, command: str = None):
         """
         Change state of the device
 
         :param state: state of the device to change to
+        :param command: ID of the command acknowledged to the server once the state changed
         """
         if state not in ['on', 'off']:
             return
@@ -74,6 +86,9 @@ class Device(asyncio.Protocol):
 
             self.log.info(f'Cancelling send_task: {msg}')
 
+        if command is not None:
+            self.send_text(f'ACK: {command} {state}')
+
     async def send_data(self):
         """
         Event loop for sending dummy data
@@ -82,14 +97,39 @@ class Device(asyncio.Protocol):
 
         while True:
             number = random.uniform(0, 100)
-            self.send(str(number))
+            ts = time.time_ns()  # time the value was taken, the consumers measure the latency from it
+            self.seq += 1  # consumers detect missed readings by gaps in the sequence numbers
+            if self.protocol == wire.BINARY:
+                self.send_reading(number, ts)
+            else:
+                self.send(json.dumps({'seq': self.seq, 'ts': ts, 'value': number}))
             await asyncio.sleep(self.rate)
 
+    def send_reading(self, value: float, ts: int):
+        """
+        Send a measurement as a binary frame stamped with sequence number and time
+        """
+        try:
+            self.transport.write(wire.encode_reading(0, self.seq, ts, value))
+            self.data_log.info('Sent reading %d %r', self.seq, value)
+        except socket.error as e:
+            self.log.error(f"Socket error while sending data: {e}")
+            self.transport.close()
+
+    def send_text(self, data: str):
+        """
+        Send a text message (e.g. an acknowledgement) in the protocol of the device
+        """
+        try:
+            self.transport.write(wire.encode_text(data, self.protocol))
+        except socket.error as e:
+            self.log.error(f"Socket error while sending data: {e}")
+            self.transport.close()
+
     def send(self, data: str):
-        data += '\n'
         try:
-            self.transport.write(data.encode())
-            self.log.info(f'Sent data {data}')
+            self.transport.write((data + '\n').encode())
+            self.data_log.info('Sent data %s', data)
         except socket.error as e:
             self.log.error(f"Socket error while sending data: {e}")
             self.transport.close()
@@ -102,10 +142,15 @@ if __name__ == "__main__":
     parser.add_argument('--state', help='Starting state of the device (e.g. on, off)', required=False, default='on')
     parser.add_argument('--addr', help='Server address', required=False, default='127.0.0.1')
     parser.add_argument('--port', help='Server port', required=False, default=50000)
+    parser.add_argument('--protocol', help='Wire protocol (e.g. json, binary)', required=False, default=wire.JSON,
+                        choices=wire.PROTOCOLS)
+    logsetup.add_arguments(parser)
     args = parser.parse_args()
+
+    logsetup.configure(args.log_format, args.log_rate)
     
     loop = asyncio.get_event_loop()
-    device = Device(device_type=args.type, state=args.state, rate=args.rate, loop=loop)
+    device = Device(device_type=args.type, state=args.state, rate=args.rate, loop=loop, protocol=args.protocol)
     coro = loop.create_connection(lambda: device, args.addr, args.port)
     loop.run_until_complete(coro)
     
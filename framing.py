@@ -0,0 +1,77 @@
+import wire
+
+
+class StreamDecoder:
+    """
+    Incremental decoder of a received byte stream for the JSON lines or binary protocol.
+
+    TCP splits and coalesces segments freely, so the received bytes are kept in a
+    single buffer and only complete lines or frames are decoded. Incomplete data
+    at the end stays in the buffer until the next call. A frame or line longer
+    than `max_length` raises wire.FrameTooLong, the connection should be closed.
+    """
+
+    def __init__(self, protocol: str = wire.JSON, max_length: int = wire.MAX_MESSAGE):
+        self.protocol = protocol
+        self.max_length = max_length
+        self.buffer = bytearray()
+        self.scanned = 0  # bytes already searched for a line end
+        self.devices = {}  # device handle table of the binary protocol
+
+    def feed(self, data: bytes) -> list:
+        """
+        Add received bytes and decode all the complete records
+
+        :param data: bytes received from the socket
+        :return: batch of Reading objects and text messages
+        """
+        self.buffer += data
+        if self.protocol == wire.BINARY:
+            return self.decode_frames()
+        return self.decode_lines()
+
+    def decode_lines(self) -> list:
+        buffer = self.buffer
+        records = []
+        start = 0
+        end = buffer.find(b'\n', self.scanned)
+        while end != -1:
+            line = buffer[start:end].decode('utf-8').strip()
+            if line:
+                records.append(wire.decode_json(line))
+            start = end + 1
+            end = buffer.find(b'\n', start)
+
+        del buffer[:start]
+        self.scanned = len(buffer)
+        if len(buffer) > self.max_length:
+            raise wire.FrameTooLong(f'Line of over {self.max_length} bytes')
+        return records
+
+    def decode_frames(self) -> list:
+        buffer = self.buffer
+        header_size = wire.HEADER.size
+        records = []
+        offset = 0
+        while len(buffer) - offset >= header_size:
+            length, kind = wire.HEADER.unpack_from(buffer, offset)
+            if length > self.max_length:
+                raise wire.FrameTooLong(f'Frame of {length} bytes over the limit of {self.max_length}')
+            body = offset + header_size
+            end = body + length
+            if end > len(buffer):
+                break
+
+            if kind == wire.READING:
+                handle, seq, ts, value, received, sent = wire.READING_BODY.unpack_from(buffer, body)
+                device_id, device_type = self.devices.get(handle, (str(handle), ''))
+                records.append(wire.Reading(ts, device_id, device_type, value, seq, received, sent))
+            elif kind == wire.DEVICE:
+                handle, device_id, device_type = wire.decode_device(bytes(buffer[body:end]))
+                self.devices[handle] = (device_id, device_type)
+            elif kind == wire.TEXT:
+                records.append(buffer[body:end].decode('utf-8'))
+            offset = end
+
+        del buffer[:offset]
+        return records
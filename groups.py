@@ -0,0 +1,113 @@
+import bisect
+import hashlib
+
+
+# Readings are partitioned between the members of a group by
+DEVICE = 'device'    # device ID, spreads the load evenly
+TYPE = 'type'        # sensor type, a member sees all the devices of its types
+
+PARTITIONS = [DEVICE, TYPE]
+
+
+def point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing ring of the members of a group.
+
+    Every member is placed on the ring at several virtual points and a key
+    belongs to the first members found clockwise from its hash. When a
+    member joins or leaves only the keys next to its points move, the rest
+    stays with their current members.
+    """
+
+    def __init__(self, vnodes: int = 64):
+        self.vnodes = vnodes
+        self.points = []  # sorted hashes of the virtual points
+        self.owners = []  # member of every point
+        self.members = set()
+
+    def add(self, member: str):
+        if member in self.members:
+            return
+        self.members.add(member)
+        for i in range(self.vnodes):
+            key = point(f'{member}#{i}')
+            index = bisect.bisect(self.points, key)
+            self.points.insert(index, key)
+            self.owners.insert(index, member)
+
+    def remove(self, member: str):
+        if member not in self.members:
+            return
+        self.members.discard(member)
+        kept = [(key, owner) for key, owner in zip(self.points, self.owners) if owner != member]
+        self.points = [key for key, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def lookup(self, key: str, count: int = 1, candidates=None) -> list:
+        """
+        Members responsible for a key
+
+        :param count: number of distinct members (replicas)
+        :param candidates: only members in this container are chosen, all if None
+        """
+        result = []
+        if not self.points:
+            return result
+
+        start = bisect.bisect(self.points, point(key))
+        for i in range(len(self.points)):
+            owner = self.owners[(start + i) % len(self.points)]
+            if owner not in result and (candidates is None or owner in candidates):
+                result.append(owner)
+                if len(result) == count:
+                    break
+        return result
+
+
+class ConsumerGroup:
+    """
+    Named group of subscribers sharing the readings, each reading goes to `replicas` members
+    """
+
+    def __init__(self, name: str, replicas: int = 1, partition: str = DEVICE):
+        if partition not in PARTITIONS:
+            raise ValueError(f'Unknown partition key: {partition}')
+        if replicas < 1:
+            raise ValueError(f'Invalid replication factor: {replicas}')
+
+        self.name = name
+        self.replicas = replicas
+        self.partition = partition
+        self.members = {}  # conn id -> Subscriber
+        self.remote = set()  # conn ids of the members connected to other server workers
+        self.ring = HashRing()
+
+    def join(self, sub):
+        self.members[sub.id] = sub
+        self.ring.add(sub.id)
+
+    def join_remote(self, conn_id: str):
+        self.remote.add(conn_id)
+        self.ring.add(conn_id)
+
+    def leave(self, conn_id: str):
+        self.members.pop(conn_id, None)
+        self.remote.discard(conn_id)
+        self.ring.remove(conn_id)
+
+    def empty(self) -> bool:
+        return not self.members and not self.remote
+
+    def owners(self, device_id: str, sensor_type: str, candidates=None) -> list:
+        """
+        Local members receiving the readings of a device, the readings of remote members are sent by their worker
+
+        :param candidates: members subscribed to the device
+        """
+        key = device_id if self.partition == DEVICE else sensor_type
+        return [self.members[member] for member in self.ring.lookup(key, self.replicas, candidates)
+                if member in self.members]
@@ -0,0 +1,105 @@
+SUB_BUCKETS = 16  # buckets per power of two, values are kept with ~6 % precision
+
+
+def bucket(value: int) -> int:
+    """
+    Index of the log-linear bucket of a non-negative integer value
+    """
+    if value < SUB_BUCKETS:
+        return max(value, 0)
+    shift = value.bit_length() - 5
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_value(index: int) -> float:
+    """
+    Middle of the range of values of a bucket
+    """
+    if index < SUB_BUCKETS:
+        return float(index)
+    shift = index // SUB_BUCKETS - 1
+    return ((SUB_BUCKETS + index % SUB_BUCKETS) << shift) + ((1 << shift) - 1) / 2
+
+
+class Histogram:
+    """
+    Log-linear histogram of latencies (or any integer values, e.g. in nanoseconds).
+
+    Recording a value increments one counter and the memory does not grow with
+    the number of values, a second of latency in nanoseconds takes ~500 buckets.
+    Percentiles are accurate to the width of a bucket.
+    """
+    __slots__ = ['counts', 'count', 'total', 'min', 'max']
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value: int):
+        index = bucket(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other: 'Histogram'):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        for value in [other.min, other.max]:
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q: percentile between 0 and 100
+        """
+        if not self.count:
+            return 0.
+        rank = max(q / 100 * self.count, 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(max(bucket_value(index), self.min), self.max)
+        return float(self.max)
+
+    def summary(self, scale: float = 1.) -> dict:
+        """
+        Count, mean, extremes and the usual percentiles divided by the scale (e.g. 1000 for microseconds)
+        """
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count / scale,
+            'min': self.min / scale,
+            'p50': self.percentile(50) / scale,
+            'p90': self.percentile(90) / scale,
+            'p99': self.percentile(99) / scale,
+            'p999': self.percentile(99.9) / scale,
+            'max': self.max / scale
+        }
+
+    def to_dict(self) -> dict:
+        return {'counts': self.counts, 'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Histogram':
+        histogram = cls()
+        histogram.counts = list(data['counts'])
+        histogram.count, histogram.total = data['count'], data['total']
+        histogram.min, histogram.max = data['min'], data['max']
+        return histogram
@@ -0,0 +1,37 @@
+class ReadingHistory:
+    """
+    Bounded ring buffer of the recent readings of a device indexed by sequence number.
+
+    A reading is stored in the slot `seq % size`, so storing it and looking up a
+    sequence number take constant time and the oldest readings are overwritten
+    once the ring is full. Sequence numbers the device skipped are missing from
+    the ring and are left out of the replayed ranges.
+    """
+    __slots__ = ['device_type', 'handle', 'size', 'slots', 'first', 'last']
+
+    def __init__(self, device_type: str, handle: int, size: int = 1000):
+        self.device_type = device_type
+        self.handle = handle
+        self.size = size
+        self.slots = [None] * size
+        self.first = None  # oldest sequence number still in the ring
+        self.last = None
+
+    def append(self, seq: int, entry: tuple):
+        self.slots[seq % self.size] = (seq, entry)
+        self.last = seq if self.last is None else max(self.last, seq)
+        self.first = max(seq if self.first is None else self.first, self.last - self.size + 1)
+
+    def range(self, start: int, end: int) -> list:
+        """
+        Stored entries with sequence numbers in [start, end] in order
+        """
+        if self.last is None:
+            return []
+
+        entries = []
+        for seq in range(max(start, self.first), min(end, self.last) + 1):
+            item = self.slots[seq % self.size]
+            if item is not None and item[0] == seq:
+                entries.append(item[1])
+        return entries
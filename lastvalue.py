@@ -0,0 +1,120 @@
+import wire
+
+
+CLEARED = 'cleared'
+
+
+def parse_alarm(alarm: str):
+    """
+    Key and state of an alarm of the form 'ALARM: ... State: raised Key: <device or type>/<check>'
+
+    :return: (key, state) or None for alarms without a key
+    """
+    rest, separator, key = alarm.rpartition(' Key: ')
+    if not separator or not key:
+        return None
+    _, separator, state = rest.rpartition(' State: ')
+    return key, state if separator else None
+
+
+class DeviceStatus:
+    """
+    Latest reading and state of a device
+    """
+    __slots__ = ['device_type', 'handle', 'state', 'acks', 'seq', 'ts', 'value', 'data']
+
+    def __init__(self, device_type: str, handle: int, state: str = None, acks: bool = False):
+        self.device_type = device_type
+        self.handle = handle
+        self.state = state
+        self.acks = acks  # the device acknowledges commands sent with an ID
+        self.seq = None  # no reading yet
+        self.ts = None
+        self.value = None
+        self.data = None
+
+    def to_dict(self) -> dict:
+        return {'type': self.device_type, 'state': self.state, 'seq': self.seq, 'ts': self.ts,
+                'date': None if self.ts is None else wire.format_time(self.ts), 'value': self.value}
+
+
+class LastValueCache:
+    """
+    Latest reading and state of every connected device and the currently active alarms.
+
+    Updating the cache costs a dictionary lookup per reading, so a new connection
+    can be sent the current values right away instead of waiting for the next
+    reading of every device, and the status can be queried without receiving the
+    stream.
+    """
+
+    def __init__(self):
+        self.devices = {}  # device id -> DeviceStatus
+        self.by_type = {}  # sensor type -> {device id: DeviceStatus}
+        self.alarms = {}  # alarm key -> latest alarm message
+
+    def add_device(self, device_id: str, device_type: str, handle: int, state: str = None, acks: bool = False):
+        if device_id not in self.devices:
+            status = self.devices[device_id] = DeviceStatus(device_type, handle, state, acks)
+            self.by_type.setdefault(device_type, {})[device_id] = status
+
+    def remove_device(self, device_id: str):
+        status = self.devices.pop(device_id, None)
+        if status is not None:
+            devices = self.by_type[status.device_type]
+            del devices[device_id]
+            if not devices:
+                del self.by_type[status.device_type]
+
+    def update(self, device_id: str, seq: int, ts: int, value: float, data: str):
+        status = self.devices.get(device_id)
+        if status is None or (status.seq is not None and seq < status.seq):
+            return  # unknown device or replayed/late reading
+        status.seq, status.ts, status.value, status.data = seq, ts, value, data
+
+    def set_state(self, device_id: str, state: str, acks: bool = None):
+        status = self.devices.get(device_id)
+        if status is not None:
+            status.state = state
+            if acks is not None:
+                status.acks = acks
+
+    def set_type_state(self, device_type: str, state: str) -> list:
+        """
+        Commands switch all the devices of a type
+
+        :return: IDs of the devices of the type
+        """
+        devices = self.by_type.get(device_type, {})
+        for status in devices.values():
+            status.state = state
+        return list(devices)
+
+    def alarm(self, alarm: str):
+        """
+        Track an alarm sent to the clients, cleared alarms are dropped
+        """
+        parsed = parse_alarm(alarm)
+        if parsed is None:
+            return
+        key, state = parsed
+        if state == CLEARED:
+            self.alarms.pop(key, None)
+        else:
+            self.alarms[key] = alarm
+
+    def readings(self) -> list:
+        """
+        :return: list of (device id, DeviceStatus) of the devices with a reading
+        """
+        return [(device_id, status) for device_id, status in self.devices.items() if status.seq is not None]
+
+    def status(self, device_type: str = None) -> dict:
+        """
+        Current values and active alarms, only of one sensor type if given
+        """
+        devices = self.devices if device_type is None else self.by_type.get(device_type, {})
+        return {
+            'devices': {device_id: status.to_dict() for device_id, status in devices.items()},
+            'alarms': list(self.alarms.values())
+        }
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+
+import metrics
+import wire
+from histogram import Histogram
+
+
+# Hops of a reading, each measured between two timestamps in nanoseconds
+DEVICE = 'device'      # taken by the device -> received by the server
+SERVER = 'server'      # received by the server -> handed to the send queues
+DELIVERY = 'delivery'  # handed to the send queues -> received by the consumer (queueing, coalescing, network)
+TOTAL = 'total'        # taken by the device -> received by the consumer
+
+HOPS = [DEVICE, SERVER, DELIVERY, TOTAL]
+
+
+class HopLatency:
+    """
+    Latency histograms of every hop of the readings received by a consumer.
+
+    Only readings sent live by the server carry its receive and send times,
+    snapshots and replays are left out. The times come from the clocks of
+    different processes, across hosts the hops include the clock offset.
+    """
+
+    def __init__(self):
+        self.histograms = {hop: Histogram() for hop in HOPS}
+        self.started = time.monotonic()
+
+    def record(self, rows: list, received: int):
+        """
+        :param rows: readings and text messages decoded from one receive
+        :param received: time the consumer received them in nanoseconds
+        """
+        device, server, delivery, total = [self.histograms[hop] for hop in HOPS]
+        for row in rows:
+            if isinstance(row, wire.Reading) and row.received:
+                device.record(max(row.received - row.ts, 0))
+                server.record(max(row.sent - row.received, 0))
+                delivery.record(max(received - row.sent, 0))
+                total.record(max(received - row.ts, 0))
+
+    @property
+    def count(self) -> int:
+        return self.histograms[TOTAL].count
+
+    def merge(self, other: 'HopLatency'):
+        for hop in HOPS:
+            self.histograms[hop].merge(other.histograms[hop])
+
+    def reset(self):
+        self.histograms = {hop: Histogram() for hop in HOPS}
+        self.started = time.monotonic()
+
+    def summary(self, scale: float = 1_000) -> dict:
+        """
+        Percentiles of every hop divided by the scale (microseconds by default)
+        """
+        return {hop: histogram.summary(scale) for hop, histogram in self.histograms.items()}
+
+    def to_dict(self) -> dict:
+        return {hop: histogram.to_dict() for hop, histogram in self.histograms.items()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'HopLatency':
+        latency = cls()
+        latency.histograms = {hop: Histogram.from_dict(data[hop]) for hop in HOPS}
+        return latency
+
+    def collect(self, scrape: metrics.Scrape):
+        for hop, histogram in self.histograms.items():
+            scrape.summary('latency_seconds', 'Latency of the readings by hop since the last latency report',
+                           histogram, 1e9, {'hop': hop})
+
+    def describe(self) -> str:
+        """
+        One line with the p50/p99/max of every hop in microseconds
+        """
+        parts = []
+        for hop, summary in self.summary().items():
+            if summary['count']:
+                parts.append(f'{hop} {summary["p50"]:.0f}/{summary["p99"]:.0f}/{summary["max"]:.0f}')
+        elapsed = time.monotonic() - self.started
+        return f'Latency over {elapsed:.0f} s of {self.count} readings (p50/p99/max us): {", ".join(parts)}'
+
+
+async def report(latency: HopLatency, log: logging.Logger, interval: float):
+    """
+    Log the latency of the readings received since the previous report every `interval` seconds
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if latency.count:
+            log.info(latency.describe())
+        latency.reset()
@@ -0,0 +1,157 @@
+import json
+import math
+import os
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, batches are then evaluated in a Python loop
+    numpy = None
+
+
+WARNING = 'warning'
+CRITICAL = 'critical'
+
+TOO_LARGE = 'large'
+TOO_SMALL = 'small'
+
+RESULTS = {
+    1: (CRITICAL, TOO_LARGE),
+    2: (CRITICAL, TOO_SMALL),
+    3: (WARNING, TOO_LARGE),
+    4: (WARNING, TOO_SMALL)
+}
+
+# Used when no limits file exists, same interval for all the known sensors
+DEFAULT_LIMITS = {
+    'types': {
+        'temp': {'critical': [10., 90.]},
+        'rad': {'critical': [10., 90.]},
+        'pres': {'critical': [10., 90.]},
+        'hum': {'critical': [10., 90.]}
+    },
+    'devices': {},
+    'detectors': {}
+}
+
+
+def parse_band(band) -> tuple:
+    """
+    Band given as [low, high], null on either side means unbounded
+    """
+    if band is None:
+        return -math.inf, math.inf
+    low, high = band
+    return -math.inf if low is None else float(low), math.inf if high is None else float(high)
+
+
+class LimitsTable:
+    """
+    Allowed value bands per sensor type and per device, loaded from a JSON file.
+
+    Each entry can have a warning and a critical band given as [low, high]. Device
+    entries take precedence over the entry of their sensor type and devices of
+    unknown types are not checked. Every device is mapped to a row of the band
+    arrays so that a batch of readings can be compared at once.
+    """
+
+    def __init__(self, filepath: str = None):
+        self.filepath = filepath
+        self.mtime = None
+        self.config = None
+        self.load()
+
+    def load(self):
+        if self.filepath is not None and os.path.exists(self.filepath):
+            self.mtime = os.stat(self.filepath).st_mtime
+            with open(self.filepath) as file:
+                config = json.load(file)
+        else:
+            config = DEFAULT_LIMITS
+
+        types = {name: self.parse_entry(entry) for name, entry in config.get('types', {}).items()}
+        devices = {name: self.parse_entry(entry) for name, entry in config.get('devices', {}).items()}
+        self.types, self.devices, self.config = types, devices, config
+
+        # Row 0 is used for devices without limits
+        self.rows = {}
+        self.bands = [(-math.inf, math.inf, -math.inf, math.inf)]
+        self.arrays = None
+
+    @staticmethod
+    def parse_entry(entry: dict) -> tuple:
+        warn_low, warn_high = parse_band(entry.get(WARNING))
+        crit_low, crit_high = parse_band(entry.get(CRITICAL))
+        return crit_low, crit_high, max(warn_low, crit_low), min(warn_high, crit_high)
+
+    def reload_if_changed(self) -> bool:
+        """
+        Load the limits file again if it was modified
+
+        :return: True if new limits were loaded
+        """
+        if self.filepath is None or not os.path.exists(self.filepath):
+            return False
+        if os.stat(self.filepath).st_mtime == self.mtime:
+            return False
+        self.load()
+        return True
+
+    def row(self, device_id: str, sensor_type: str) -> int:
+        row = self.rows.get(device_id)
+        if row is None:
+            bands = self.devices.get(device_id) or self.types.get(sensor_type)
+            if bands is None:
+                row = 0
+            else:
+                row = len(self.bands)
+                self.bands.append(bands)
+                self.arrays = None
+            self.rows[device_id] = row
+        return row
+
+    def in_range(self, device_id: str, sensor_type: str, value: float, margin: float = 0.) -> bool:
+        """
+        Check if the value is inside the warning band of the device narrowed by the margin
+        """
+        _, _, warn_low, warn_high = self.bands[self.row(device_id, sensor_type)]
+        return warn_low + margin <= value <= warn_high - margin
+
+    def evaluate(self, readings: list) -> list:
+        """
+        Compare a batch of readings with their bands
+
+        :return: list of (reading, level, direction) for the readings outside of a band
+        """
+        if not readings:
+            return []
+        if numpy is None:
+            return self.evaluate_python(readings)
+
+        rows = numpy.fromiter((self.row(r.device_id, r.sensor_type) for r in readings), numpy.intp, len(readings))
+        values = numpy.fromiter((r.value for r in readings), numpy.float64, len(readings))
+        if self.arrays is None:
+            self.arrays = numpy.array(self.bands, dtype=numpy.float64).T
+        crit_low, crit_high, warn_low, warn_high = (band[rows] for band in self.arrays)
+
+        # Checked from the least to the most severe so the most severe band wins
+        codes = numpy.zeros(len(readings), dtype=numpy.int8)
+        codes[values < warn_low] = 4
+        codes[values > warn_high] = 3
+        codes[values < crit_low] = 2
+        codes[values > crit_high] = 1
+        return [(readings[i], *RESULTS[int(codes[i])]) for i in numpy.flatnonzero(codes)]
+
+    def evaluate_python(self, readings: list) -> list:
+        result = []
+        for reading in readings:
+            crit_low, crit_high, warn_low, warn_high = self.bands[self.row(reading.device_id, reading.sensor_type)]
+            value = reading.value
+            if value > crit_high:
+                result.append((reading, CRITICAL, TOO_LARGE))
+            elif value < crit_low:
+                result.append((reading, CRITICAL, TOO_SMALL))
+            elif value > warn_high:
+                result.append((reading, WARNING, TOO_LARGE))
+            elif value < warn_low:
+                result.append((reading, WARNING, TOO_SMALL))
+        return result
@@ -0,0 +1,139 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+
+# Output formats of the log records
+TEXT = 'text'
+JSON = 'json'
+
+FORMATS = [TEXT, JSON]
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Listener of the current process, a forked worker starts its own
+listener = None
+listener_pid = None
+settings = {'rate': 10., 'burst': 20}
+
+
+class TextFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f'{text} ({suppressed} similar suppressed)' if suppressed else text
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line so the logs can be filtered and aggregated by tools
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        return json.dumps(entry)
+
+
+class RateLimit(logging.Filter):
+    """
+    Token bucket letting through at most `rate` records per second of a logger, in bursts of up to `burst`.
+
+    Dropped records are counted and the count is attached to the next record
+    that passes, so the output shows how much was left out.
+    """
+
+    def __init__(self, rate: float, burst: int = 20):
+        super().__init__()
+        self.rate = rate
+        self.burst = max(burst, 1) if rate > 0 else 0  # a rate of 0 drops all the records
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        record.suppressed, self.dropped = self.dropped, 0
+        return True
+
+
+def configure(log_format: str = TEXT, rate: float = 10., level: int = logging.INFO, stream=None):
+    """
+    Send the records of all the loggers through a queue to a background thread writing them out.
+
+    The thread doing the work only puts the record in the queue, formatting and
+    writing to the stream never blocks the event loop.
+
+    :param rate: records per second let through by the sampled loggers of the frequent messages
+    """
+    global listener, listener_pid
+    shutdown()
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == JSON else TextFormatter())
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener_pid = os.getpid()
+    listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    settings['rate'] = rate
+
+
+@atexit.register
+def shutdown():
+    """
+    Write out the queued records, called at exit and by processes that leave without running the exit handlers
+    """
+    global listener
+    if listener is not None and listener_pid == os.getpid():
+        listener.stop()
+    listener = None
+
+
+def get_logger(name: str, sampled: bool = False) -> logging.Logger:
+    """
+    Logger of a component, the shared setup is created on first use
+
+    :param sampled: limit the records per second, for messages logged on every reading
+    """
+    if listener is None or listener_pid != os.getpid():
+        configure(rate=settings['rate'])
+
+    log = logging.getLogger(name)
+    if sampled and not any(isinstance(f, RateLimit) for f in log.filters):
+        log.addFilter(RateLimit(settings['rate'], settings['burst']))
+    return log
+
+
+def add_arguments(parser):
+    """
+    Logging options shared by the scripts
+    """
+    parser.add_argument('--log_format', help='Format of the log output (e.g. text, json)', required=False,
+                        default=TEXT, choices=FORMATS)
+    parser.add_argument('--log_rate', help='Records per second logged of the frequent messages (e.g. every reading)',
+                        required=False, default=10, type=float)
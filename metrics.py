@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import math
+
+from histogram import Histogram
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+
+QUANTILES = [0.5, 0.9, 0.99, 0.999]
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+JSON_CONTENT_TYPE = 'application/json'
+
+
+class ConnectionStats:
+    """
+    Messages and bytes read from a connection, updated for every message
+    """
+    __slots__ = ['received', 'received_bytes']
+
+    def __init__(self):
+        self.received = 0
+        self.received_bytes = 0
+
+
+class Family:
+    """
+    Samples of one metric, e.g. the messages received by every connection
+    """
+    __slots__ = ['name', 'kind', 'help', 'samples']
+
+    def __init__(self, name: str, kind: str, help_text: str):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.samples = []  # (name, labels, value)
+
+
+class Scrape:
+    """
+    Metrics of one request, filled in by the collectors of the registry
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.families = {}
+
+    def family(self, name: str, kind: str, help_text: str) -> Family:
+        name = f'{self.prefix}_{name}'
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, kind, help_text)
+        return family
+
+    def counter(self, name: str, help_text: str, value, labels: dict = None):
+        family = self.family(name, COUNTER, help_text)
+        family.samples.append((family.name, labels or {}, value))
+
+    def gauge(self, name: str, help_text: str, value, labels: dict = None):
+        family = self.family(name, GAUGE, help_text)
+        family.samples.append((family.name, labels or {}, value))
+
+    def summary(self, name: str, help_text: str, histogram: Histogram, scale: float = 1., labels: dict = None):
+        """
+        Quantiles, sum and count of a histogram, the values are divided by the scale (e.g. 1e9 for ns to seconds)
+        """
+        family = self.family(name, SUMMARY, help_text)
+        labels = labels or {}
+        for quantile in QUANTILES:
+            value = histogram.percentile(quantile * 100) / scale if histogram.count else math.nan
+            family.samples.append((family.name, {**labels, 'quantile': str(quantile)}, value))
+        family.samples.append((f'{family.name}_sum', labels, histogram.total / scale))
+        family.samples.append((f'{family.name}_count', labels, histogram.count))
+
+
+class Registry:
+    """
+    Counters and gauges of a component, served in the Prometheus text format and as JSON.
+
+    The hot paths only add to plain integers of their own objects (the event
+    loop is single-threaded, so no locks are needed). The collectors read them
+    and turn them into samples only when the metrics are requested.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.collectors = []
+
+    def register(self, collector):
+        """
+        :param collector: function called with a Scrape to add the samples of a part of the component
+        """
+        self.collectors.append(collector)
+
+    def collect(self) -> list:
+        scrape = Scrape(self.prefix)
+        for collector in self.collectors:
+            collector(scrape)
+        return list(scrape.families.values())
+
+    def to_text(self) -> str:
+        lines = []
+        for family in self.collect():
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            for name, labels, value in family.samples:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> dict:
+        return {family.name: {
+            'type': family.kind,
+            'help': family.help,
+            'samples': [{'name': name, 'labels': labels, 'value': None if value != value else value}
+                        for name, labels, value in family.samples]
+        } for family in self.collect()}
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+
+class LoopLag:
+    """
+    Delay of the event loop, measured by a task waking up every `interval` seconds.
+
+    A blocking call or a long burst of work shows up as a late wake up. The
+    quantiles cover the current and the previous window of `window` seconds,
+    so spikes stay visible for at least one window.
+    """
+
+    def __init__(self, interval: float = 0.1, window: float = 60.):
+        self.interval = interval
+        self.window = window
+        self.current = Histogram()
+        self.previous = Histogram()
+        self.max = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        window_start = loop.time()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            lag = max(int((now - start - self.interval) * 1_000_000_000), 0)
+            self.current.record(lag)
+            self.max = max(self.max, lag)
+            if now - window_start >= self.window:
+                self.previous, self.current = self.current, Histogram()
+                window_start = now
+
+    def collect(self, scrape: Scrape):
+        histogram = Histogram()
+        histogram.merge(self.previous)
+        histogram.merge(self.current)
+        scrape.summary('event_loop_lag_seconds', 'Delay of the event loop waking up a timer', histogram, 1e9)
+        scrape.gauge('event_loop_lag_max_seconds', 'Longest delay of the event loop since the start', self.max / 1e9)
+
+
+async def handle_request(registry: Registry, log: logging.Logger, reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter):
+    """
+    Minimal HTTP/1.0 endpoint: /metrics in the text format, /metrics.json (or ?format=json) as JSON
+    """
+    try:
+        request = (await reader.readline()).decode('latin-1').split()
+        while (await reader.readline()).strip():
+            pass  # headers are not used
+
+        path = request[1] if len(request) > 1 else '/metrics'
+        path, _, query = path.partition('?')
+        if path == '/metrics.json' or (path in ['/', '/metrics'] and 'format=json' in query):
+            status, content_type, body = '200 OK', JSON_CONTENT_TYPE, json.dumps(registry.to_dict())
+        elif path in ['/', '/metrics']:
+            status, content_type, body = '200 OK', TEXT_CONTENT_TYPE, registry.to_text()
+        else:
+            status, content_type, body = '404 Not Found', TEXT_CONTENT_TYPE, 'Not found\n'
+
+        body = body.encode()
+        writer.write(f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (ConnectionError, UnicodeDecodeError) as e:
+        log.warning(f'Error while serving metrics: {e}')
+    finally:
+        writer.close()
+
+
+async def serve(registry: Registry, port: int, log: logging.Logger, addr: str = '127.0.0.1') -> asyncio.AbstractServer:
+    """
+    Serve the metrics of the registry on a local port
+    """
+    server = await asyncio.start_server(lambda reader, writer: handle_request(registry, log, reader, writer),
+                                        addr, port)
+    log.info(f'Serving metrics on http://{addr}:{port}/metrics')
+    return server
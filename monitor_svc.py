@@ -1,24 +1,73 @@
 import argparse
 import asyncio
+import collections
 import json
 import random
 import socket
-import logging
-import sys
+import time
+
+import latency
+import logsetup
+import metrics
+import wire
+from alarms import AlarmTracker
+from framing import StreamDecoder
+from groups import PARTITIONS, TYPE as PARTITION_TYPE
+from correlation import Correlation, FACILITY
+from detectors import Detectors, DESCRIPTIONS
+from limits import LimitsTable, CRITICAL, WARNING
+
+
+LIMIT = 'limit'
 
 
 class Monitor(asyncio.Protocol):
 
-    def __init__(self, loop: asyncio.AbstractEventLoop, filepath: str = None):
+    def __init__(self, loop: asyncio.AbstractEventLoop, filepath: str = None, protocol: str = wire.JSON,
+                 limits_path: str = None, reload_interval: float = 5., group: str = None,
+                 partition: str = PARTITION_TYPE, latency_interval: float = 10.):
+        """
+        :param group: consumer group sharing the devices with other monitors, all devices are monitored if None
+        :param partition: devices are shared by 'type' (keeps the correlation of a type in one monitor) or 'device'
+        :param latency_interval: time in seconds between logs of the latency of every hop, 0 disables
+        """
         self.loop = loop
         self.transport = None
+        self.protocol = protocol
+        self.group = group
+        self.partition = partition
+        self.decoder = StreamDecoder(protocol)
+        self.reload_task = None
 
-        self.limits = {
-            'temp': [10., 90.],
-            'rad': [10., 90.],
-            'pres': [10., 90.],
-            'hum': [10., 90.]
-        }
+        # Latency from the devices through the server to the monitor
+        self.latency = latency.HopLatency()
+        self.latency_interval = latency_interval
+        self.latency_task = None
+
+        # Counters served as metrics
+        self.received = 0
+        self.received_bytes = 0
+        self.readings = 0
+        self.sent = 0
+        self.transitions = collections.Counter()  # alarm state -> notifications
+        self.metrics = metrics.Registry('monitor')
+        self.metrics.register(self.collect_metrics)
+        self.metrics.register(self.latency.collect)
+        self.metrics_server = None
+        self.loop_lag_task = None
+
+        # Limits are reloaded when the file changes
+        self.limits = LimitsTable(limits_path)
+        self.reload_interval = reload_interval
+
+        # Anomaly detectors per sensor type and correlation between sensors are configured in the same file
+        self.detectors = Detectors(self.limits.config.get('detectors'))
+        self.correlation = Correlation(**self.limits.config.get('correlation', {}))
+
+        # Alarm conditions are turned into raised/active/cleared state transitions
+        self.alarms = AlarmTracker()
+        self.hysteresis = 0.
+        self.configure_alarms(self.limits.config.get('alarms', {}))
 
         if filepath is None:
             filepath = f'./monitors/monitor{random.randint(1, 10000)}.txt'
@@ -28,40 +77,87 @@ class Monitor(asyncio.Protocol):
         self.file = open(self.filepath, 'a+')
 
         # Initialization of logger
-        self.log = logging.getLogger('Monitor')
-        handler = logging.StreamHandler(sys.stdout)
-
-        # Datetime formatting setup
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-
-        self.log.addHandler(handler)
-        self.log.setLevel(logging.INFO)
+        self.log = logsetup.get_logger('Monitor')
+        self.data_log = logsetup.get_logger('Monitor.data', sampled=True)
 
     def connection_made(self, transport: asyncio.Transport):
         self.transport = transport
 
-        self.send(json.dumps({
-            'type': 'monitor'
-        }))
+        handshake = {
+            'type': 'monitor',
+            'protocol': self.protocol
+        }
+        if self.group is not None:
+            handshake.update(group=self.group, partition=self.partition)
+        self.send(json.dumps(handshake), wire.JSON)
+
+        self.reload_task = asyncio.create_task(self.reload_limits())
+        if self.latency_interval > 0:
+            self.latency_task = asyncio.create_task(latency.report(self.latency, self.log, self.latency_interval))
 
         self.log.info('Connection made')
 
+    def configure_alarms(self, config: dict):
+        self.alarms.renotify = config.get('renotify', 60.)
+        self.alarms.clear_after = config.get('clear_after', 10.)
+        self.hysteresis = config.get('hysteresis', 2.)
+
     def data_received(self, data: bytes):
-        data = data.decode('utf-8').strip()
-        data = self.parse_msg(data)
+        received = time.time_ns()
+        self.received_bytes += len(data)
+        try:
+            rows = self.parse_msg(data)
+        except ValueError as e:
+            self.log.error(f'Invalid data from the server, closing the connection: {e}')
+            self.transport.close()
+            return
+        data = [row for row in rows if isinstance(row, wire.Reading)]
+        self.received += len(rows)
+        self.readings += len(data)
+        self.latency.record(data, received)
+
+        # Alarm conditions of the batch as (key, level, message)
+        conditions = []
+        breaches = self.limits.evaluate(data)
+        for row, level, direction in breaches:
+            conditions.append(((row.device_id, LIMIT), level,
+                               f'ALARM: Value too {direction}: {row.value} Sensor: {row.sensor_type} '
+                               f'ID: {row.device_id} Level: {level}'))
+
+        critical = [row for row, level, _ in breaches if level == CRITICAL]
+        for kind, sensor_type, row, detail in self.correlation.update(data, critical):
+            if kind == FACILITY:
+                conditions.append(((sensor_type, kind), CRITICAL,
+                                   f'ALARM: {kind} Sensor: {sensor_type} {detail} Level: critical'))
+            else:
+                conditions.append(((row.device_id, kind), WARNING,
+                                   f'ALARM: {kind} Value: {row.value} Sensor: {sensor_type} ID: {row.device_id} '
+                                   f'{detail} Level: warning'))
 
-        alarms = []
         for row in data:
-            row = row[1]
-            if row[1] not in self.limits:
-                continue
+            for detector, detail in self.detectors.update(row):
+                conditions.append(((row.device_id, detector), WARNING,
+                                   f'ALARM: {DESCRIPTIONS[detector]}: {row.value} Sensor: {row.sensor_type} '
+                                   f'ID: {row.device_id} {detail} Level: warning'))
 
-            if float(row[-1]) > self.limits[row[1]][1]:
-                alarms.append('ALARM: Value too large: {} Sensor: {} ID: {}'.format(row[-1], row[1], row[0]))
-            elif float(row[-1]) < self.limits[row[1]][0]:
-                alarms.append('ALARM: Value too small: {} Sensor: {} ID: {}'.format(row[-1], row[1], row[0]))
+        now = time.time()
+        transitions = [(key, self.alarms.fire(key, level, message, now)) for key, level, message in conditions]
 
+        # Limit alarms are cleared once the value is back in range by the hysteresis margin
+        breached = {row.device_id for row, _, _ in breaches}
+        for row in data:
+            key = (row.device_id, LIMIT)
+            if key in self.alarms.active and row.device_id not in breached and \
+                    self.limits.in_range(row.device_id, row.sensor_type, row.value, self.hysteresis):
+                transitions.append((key, self.alarms.clear(key)))
+        transitions.extend(self.alarms.expire(now, keep=lambda key: key[1] == LIMIT))
+
+        # The key lets the server track which alarms are still active
+        alarms = [f'{transition[1]} State: {transition[0]} Key: {key[0]}/{key[1]}'
+                  for key, transition in transitions if transition is not None]
+        for key, transition in transitions:
+            if transition is not None:
+                self.transitions[transition[0]] += 1
         if alarms:
             for row in alarms:
                 self.log.warning(row)
@@ -69,21 +165,58 @@ class Monitor(asyncio.Protocol):
                 self.file.write('\n')
             self.send('\n'.join(alarms))
 
+    def collect_metrics(self, scrape: metrics.Scrape):
+        scrape.counter('messages_in_total', 'Messages received from the server', self.received)
+        scrape.counter('bytes_in_total', 'Bytes received from the server', self.received_bytes)
+        scrape.counter('messages_out_total', 'Messages sent to the server', self.sent)
+        scrape.counter('readings_total', 'Readings checked', self.readings)
+        for state, count in sorted(self.transitions.items()):
+            scrape.counter('alarms_total', 'Alarm notifications sent by state', count, {'state': state})
+        scrape.gauge('alarms_active', 'Active alarms', len(self.alarms.active))
+
+    async def serve_metrics(self, port: int):
+        """
+        Serve the metrics on a local port and start measuring the delay of the event loop
+        """
+        loop_lag = metrics.LoopLag()
+        self.metrics.register(loop_lag.collect)
+        self.loop_lag_task = asyncio.create_task(loop_lag.run())
+        self.metrics_server = await metrics.serve(self.metrics, port, self.log)
+
+    async def reload_limits(self):
+        """
+        Event loop checking the limits file for changes
+        """
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if self.limits.reload_if_changed():
+                    self.detectors.configure(self.limits.config.get('detectors', {}))
+                    self.correlation = Correlation(**self.limits.config.get('correlation', {}))
+                    self.configure_alarms(self.limits.config.get('alarms', {}))
+                    self.log.info(f'Reloaded limits from {self.limits.filepath}')
+            except (OSError, ValueError, TypeError) as e:
+                self.log.error(f'Error while loading limits, keeping the previous ones: {e}')
+
     def connection_lost(self, exc):
         self.log.info('Connection lost')
+        for task in [self.reload_task, self.latency_task, self.loop_lag_task]:
+            if task is not None:
+                task.cancel()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
         self.file.close()  # Close the file when connection is lost
         if exc:
             self.log.error(f'Error: {exc}')
 
-    def parse_msg(self, data: str):
-        data = data.split('\n')
-        return [json.loads(d) for d in data]
+    def parse_msg(self, data: bytes):
+        return self.decoder.feed(data)
 
-    def send(self, data: str):
-        data += '\n'
+    def send(self, data: str, protocol: str = None):
         try:
-            self.transport.write(data.encode())
-            self.log.info(f'Sent data {data}')
+            self.transport.write(wire.encode_text(data, protocol or self.protocol))
+            self.sent += 1
+            self.data_log.info('Sent data %s', data)
         except socket.error as e:
             self.log.error(f"Socket error while sending data: {e}")
             self.transport.close()
@@ -93,10 +226,30 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='New monitor setup')
     parser.add_argument('--addr', help='Server address', required=False, default='127.0.0.1')
     parser.add_argument('--port', help='Server port', required=False, default=50000)
+    parser.add_argument('--protocol', help='Wire protocol (e.g. json, binary)', required=False, default=wire.JSON,
+                        choices=wire.PROTOCOLS)
+    parser.add_argument('--limits', help='Path of the limits file', required=False, default='./monitor_limits.json')
+    parser.add_argument('--reload_interval', help='Interval in seconds for checking the limits file for changes',
+                        required=False, default=5, type=float)
+    parser.add_argument('--group', help='Consumer group sharing the devices between monitors', required=False,
+                        default=None)
+    parser.add_argument('--partition', help='Share the devices of the group by sensor type or device',
+                        required=False, default=PARTITION_TYPE, choices=PARTITIONS)
+    parser.add_argument('--latency_interval', help='Interval in seconds for logging the latency of every hop of the '
+                                                   'readings (0 disables)', required=False, default=10, type=float)
+    parser.add_argument('--metrics_port', help='Local port serving the metrics (0 disables)', required=False,
+                        default=0, type=int)
+    logsetup.add_arguments(parser)
     args = parser.parse_args()
 
+    logsetup.configure(args.log_format, args.log_rate)
+
     loop = asyncio.get_event_loop()
-    monitor = Monitor(loop=loop)
+    monitor = Monitor(loop=loop, protocol=args.protocol, limits_path=args.limits,
+                      reload_interval=args.reload_interval, group=args.group, partition=args.partition,
+                      latency_interval=args.latency_interval)
+    if args.metrics_port:
+        loop.run_until_complete(monitor.serve_metrics(args.metrics_port))
     coro = loop.create_connection(lambda: monitor, args.addr, args.port)
     loop.run_until_complete(coro)
 
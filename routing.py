@@ -0,0 +1,252 @@
+import collections
+
+from groups import ConsumerGroup, DEVICE as PARTITION_DEVICE
+
+
+# Subscription topics
+ALL = 'all'          # every reading
+TYPE = 'type'        # readings of a sensor type
+DEVICE = 'device'    # readings of a device ID
+ALARMS = 'alarms'    # no readings, only alarms and replies
+AGGREGATE = 'aggregate'  # aggregates of an interval instead of the readings
+
+TOPICS = [ALL, TYPE, DEVICE, ALARMS, AGGREGATE]
+
+
+class Subscription:
+    """
+    Readings a connection wants to receive, or their aggregates if `aggregate` is the interval of the windows
+    """
+    __slots__ = ['all', 'types', 'devices', 'aggregate']
+
+    def __init__(self, everything: bool = True, types=(), devices=(), aggregate: float = None):
+        self.all = everything
+        self.types = set(types)
+        self.devices = set(devices)
+        self.aggregate = aggregate
+
+    @classmethod
+    def from_handshake(cls, config: dict) -> 'Subscription':
+        """
+        Subscription from the 'subscribe' field of the handshake, e.g.
+        {"types": ["rad"], "devices": ["<device id>"]}, {"alarms_only": true} or {"aggregate": 10, "types": ["rad"]}
+
+        :param config: field of the handshake, everything is subscribed if None
+        """
+        if config is None:
+            return cls()
+        if not isinstance(config, dict):
+            raise ValueError(f'Invalid subscription: {config}')
+
+        types = config.get('types') or []
+        devices = config.get('devices') or []
+        if config.get('alarms_only'):
+            return cls(False)
+        aggregate = config.get('aggregate')
+        if aggregate is not None:
+            aggregate = float(aggregate)
+        return cls(not types and not devices, types, devices, aggregate)
+
+    @classmethod
+    def from_dict(cls, config: dict) -> 'Subscription':
+        """
+        Subscription from the result of `to_dict`, e.g. forwarded to the other server workers
+        """
+        return cls(config.get(ALL, False), config.get('types', ()), config.get('devices', ()), config.get(AGGREGATE))
+
+    def matches(self, device_id: str, sensor_type: str) -> bool:
+        """
+        Whether the readings of the device are subscribed
+        """
+        return self.aggregate is None and (self.all or sensor_type in self.types or device_id in self.devices)
+
+    def to_dict(self) -> dict:
+        result = {ALL: True} if self.all else {'types': sorted(self.types), 'devices': sorted(self.devices)}
+        if self.aggregate is not None:
+            result[AGGREGATE] = self.aggregate
+        return result
+
+
+class RoutingIndex:
+    """
+    Index from topic to the subscribers interested in it.
+
+    The subscribers of a device are resolved once, from the subscribers of all
+    readings, of its sensor type and of its ID, and cached until a subscription
+    changes. Routing a reading then costs time proportional to its interested
+    subscribers and not to all the connections.
+
+    Subscribers in a consumer group share the readings, of the interested
+    members of a group only the ones owning the device on the hash ring of
+    the group receive them. Members connected to other server workers are
+    filtered by the subscription their worker forwarded, so a reading is
+    only ever owned by members that want it. Subscribers of aggregates are kept apart and get
+    no readings.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}  # conn id -> Subscription
+        self.subscribers = {}  # conn id -> Subscriber
+        self.everything = {}
+        self.by_type = collections.defaultdict(dict)
+        self.by_device = collections.defaultdict(dict)
+        self.aggregates = {}  # conn id -> Subscriber of aggregates
+        self.routes = {}  # device id -> list of subscribers
+        self.groups = {}  # group name -> ConsumerGroup
+        self.member_of = {}  # conn id -> group name
+        self.remote = {}  # conn id -> Subscription of a group member connected to another server worker
+
+    def add(self, sub, subscription: Subscription, group: str = None, replicas: int = 1,
+            partition: str = PARTITION_DEVICE):
+        """
+        :param group: name of the consumer group to join, the subscriber receives all its readings if None
+        :param replicas: members receiving each reading, used when the group is created
+        :param partition: partition key of the group, used when the group is created
+        """
+        if group is not None:
+            if group not in self.groups:
+                self.groups[group] = ConsumerGroup(group, replicas, partition)
+            self.groups[group].join(sub)
+            self.member_of[sub.id] = group
+
+        self.subscribers[sub.id] = sub
+        self.subscriptions[sub.id] = subscription
+        self.index(sub, subscription)
+
+    def remove(self, conn_id: str):
+        sub = self.subscribers.pop(conn_id, None)
+        if sub is None:
+            return
+
+        self.leave_group(conn_id)
+        self.unindex(sub, self.subscriptions.pop(conn_id))
+
+    def add_remote(self, conn_id: str, group: str, replicas: int = 1, partition: str = PARTITION_DEVICE,
+                   subscription: Subscription = None):
+        """
+        Add a group member connected to another server worker, it takes its share of the subscribed devices
+        of the group
+
+        :param subscription: subscription of the member, everything if None
+        """
+        if group not in self.groups:
+            self.groups[group] = ConsumerGroup(group, replicas, partition)
+        self.groups[group].join_remote(conn_id)
+        self.member_of[conn_id] = group
+        self.remote[conn_id] = subscription or Subscription()
+        self.routes.clear()
+
+    def update_remote(self, conn_id: str, subscription: Subscription):
+        """
+        Change the subscription of a group member connected to another server worker
+        """
+        if conn_id in self.remote:
+            self.remote[conn_id] = subscription
+            self.routes.clear()
+
+    def leave_group(self, conn_id: str):
+        group = self.member_of.pop(conn_id, None)
+        self.remote.pop(conn_id, None)
+        if group is not None:
+            self.groups[group].leave(conn_id)
+            if self.groups[group].empty():
+                del self.groups[group]
+            self.routes.clear()
+
+    def index(self, sub, subscription: Subscription):
+        if subscription.aggregate is not None:
+            self.aggregates[sub.id] = sub
+            return
+        if subscription.all:
+            self.everything[sub.id] = sub
+        for sensor_type in subscription.types:
+            self.by_type[sensor_type][sub.id] = sub
+        for device_id in subscription.devices:
+            self.by_device[device_id][sub.id] = sub
+        self.routes.clear()
+
+    def unindex(self, sub, subscription: Subscription):
+        self.everything.pop(sub.id, None)
+        self.aggregates.pop(sub.id, None)
+        for topics, names in [(self.by_type, subscription.types), (self.by_device, subscription.devices)]:
+            for name in names:
+                subscribers = topics[name]
+                subscribers.pop(sub.id, None)
+                if not subscribers:
+                    del topics[name]
+        self.routes.clear()
+
+    def update(self, conn_id: str, subscribe: bool, topic: str, name: str = None) -> Subscription:
+        """
+        Change the subscription of a connection
+
+        :param subscribe: True to subscribe to the topic, False to unsubscribe
+        :param topic: one of TOPICS, 'type' and 'device' need the name of the sensor type or device,
+                      'aggregate' the interval of the windows
+        :return: new subscription
+        """
+        if topic not in TOPICS:
+            raise ValueError(f'Unknown topic: {topic}')
+        if (topic in [TYPE, DEVICE] or (topic == AGGREGATE and subscribe)) and not name:
+            raise ValueError(f'Missing {topic} name')
+        aggregate = float(name) if topic == AGGREGATE and subscribe else None
+
+        sub = self.subscribers[conn_id]
+        subscription = self.subscriptions[conn_id]
+        self.unindex(sub, subscription)
+
+        if topic == ALL:
+            subscription.all = subscribe
+            subscription.aggregate = None
+        elif topic == ALARMS:
+            # Alarms are always received, subscribing to them alone drops all the readings
+            subscription.all = not subscribe
+            subscription.types.clear()
+            subscription.devices.clear()
+            subscription.aggregate = None
+        elif topic == AGGREGATE:
+            # The types and devices of the subscription select the aggregates
+            subscription.aggregate = aggregate
+        else:
+            names = subscription.types if topic == TYPE else subscription.devices
+            if subscribe:
+                names.add(name)
+                subscription.all = False
+            else:
+                names.discard(name)
+
+        self.index(sub, subscription)
+        return subscription
+
+    def route(self, device_id: str, sensor_type: str) -> list:
+        """
+        Subscribers of the readings of a device
+        """
+        subscribers = self.routes.get(device_id)
+        if subscribers is None:
+            targets = dict(self.everything)
+            targets.update(self.by_type.get(sensor_type, {}))
+            targets.update(self.by_device.get(device_id, {}))
+
+            subscribers = []
+            groups = set()
+            for conn_id, sub in targets.items():
+                group = self.member_of.get(conn_id)
+                if group is None:
+                    subscribers.append(sub)
+                else:
+                    groups.add(group)
+            for group in groups:
+                group = self.groups[group]
+                candidates = set(targets)
+                candidates.update(conn_id for conn_id in group.remote
+                                  if self.remote[conn_id].matches(device_id, sensor_type))
+                subscribers.extend(group.owners(device_id, sensor_type, candidates))
+            self.routes[device_id] = subscribers
+        return subscribers
+
+    def forget(self, device_id: str):
+        """
+        Drop the cached subscribers of a disconnected device
+        """
+        self.routes.pop(device_id, None)
@@ -0,0 +1,170 @@
+import asyncio
+import collections
+import logging
+import socket
+
+import wire
+
+
+# Overflow policies for the send queues
+BLOCK = 'block'                # publisher waits until there is space (no data is lost)
+DROP_OLDEST = 'drop_oldest'    # oldest queued message is discarded to make room
+NEVER_DROP = 'never_drop'      # queue grows past its bound and an alert is raised
+
+POLICIES = [BLOCK, DROP_OLDEST, NEVER_DROP]
+
+
+class Subscriber:
+    """
+    Connection receiving data from the server through its own bounded send queue.
+
+    Every subscriber has a dedicated writer task so that a slow socket only
+    delays its own queue and never the device read loops of the server.
+    Messages are queued already encoded and the ones arriving within the
+    coalescing window are written out together with a single drain.
+    """
+
+    def __init__(self, conn_id: str, conn_type: str, writer: asyncio.StreamWriter,
+                 policy: str, maxsize: int, log: logging.Logger, on_overflow=None,
+                 coalesce_window: float = 0.005, batch_size: int = 64, protocol: str = wire.JSON):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown overflow policy: {policy}')
+
+        self.id = conn_id
+        self.type = conn_type
+        self.protocol = protocol
+        self.writer = writer
+        self.policy = policy
+        self.maxsize = maxsize
+        self.log = log
+        self.on_overflow = on_overflow
+        self.coalesce_window = coalesce_window
+        self.batch_size = batch_size
+
+        self.queue = collections.deque()
+        self.not_empty = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+        # Counters exposed per connection
+        self.sent = 0
+        self.sent_bytes = 0
+        self.writes = 0
+        self.drain_time = 0.  # seconds spent waiting for the socket to take the writes
+        self.received = 0  # messages and bytes read from the connection by the server
+        self.received_bytes = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.overflowing = False
+        self.closed = False
+
+        self.task = asyncio.create_task(self.run())
+
+    def offer(self, data: bytes) -> bool:
+        """
+        Enqueue data without waiting
+
+        :param data: encoded message to send, shared between all subscribers
+        :return: False if the policy requires the caller to wait for space
+        """
+        if self.closed:
+            return True
+
+        if len(self.queue) >= self.maxsize:
+            if self.policy == BLOCK:
+                return False
+            elif self.policy == DROP_OLDEST:
+                self.queue.popleft()
+                self.dropped += 1
+            elif not self.overflowing:
+                self.overflowing = True
+                self.log.warning(f'Send queue of {self.type} {self.id} exceeded {self.maxsize} messages')
+                if self.on_overflow is not None:
+                    self.on_overflow(self)
+
+        self.queue.append(data)
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.not_empty.set()
+        if len(self.queue) >= self.batch_size:
+            self.batch_full.set()
+        return True
+
+    async def put(self, data: bytes):
+        """
+        Enqueue data, waiting for space if the queue is full and the policy is blocking
+        """
+        while not self.offer(data):
+            self.not_full.clear()
+            await self.not_full.wait()
+
+    async def run(self):
+        """
+        Writer task draining the send queue into the socket in coalesced batches
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if not self.queue:
+                    self.not_empty.clear()
+                    await self.not_empty.wait()
+                    continue
+
+                # Give the following messages a short window to join this write
+                if self.coalesce_window > 0 and len(self.queue) < self.batch_size:
+                    self.batch_full.clear()
+                    timer = loop.call_later(self.coalesce_window, self.batch_full.set)
+                    await self.batch_full.wait()
+                    timer.cancel()
+
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), self.batch_size))]
+                self.not_full.set()
+                if self.overflowing and len(self.queue) < self.maxsize:
+                    self.overflowing = False
+                    self.log.info(f'Send queue of {self.type} {self.id} is back under its limit')
+
+                self.writer.writelines(batch)
+                started = loop.time()
+                await self.writer.drain()  # await to ensure task completion
+                self.drain_time += loop.time() - started
+                self.sent += len(batch)
+                self.sent_bytes += sum(map(len, batch))
+                self.writes += 1
+        except asyncio.CancelledError:
+            pass
+        except (socket.error, ConnectionError) as e:
+            self.log.error(f'Socket error while sending data to {self.type} {self.id}: {e}')
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop accepting data and release any publisher waiting for space
+        """
+        self.closed = True
+        self.queue.clear()
+        self.not_full.set()
+
+    async def close(self):
+        """
+        Stop the writer task and close the connection
+        """
+        self.stop()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    def stats(self) -> dict:
+        return {
+            'type': self.type,
+            'protocol': self.protocol,
+            'policy': self.policy,
+            'depth': len(self.queue),
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'sent_bytes': self.sent_bytes,
+            'writes': self.writes,
+            'drain_time': self.drain_time,
+            'dropped': self.dropped
+        }
@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import os
+import time
+
+import logsetup
+import wire
+from archive_store import HEADER, Segment, list_segments
+from benchmark import SimDevice
+
+
+class ReplayDevice(SimDevice):
+    """
+    Connection of a device of the trace, asking the server to keep its original ID
+    """
+
+    def __init__(self, device_id: str, device_type: str, protocol: str):
+        super().__init__(device_type, protocol)
+        self.id = device_id
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        transport.write((json.dumps({
+            'type': 'device',
+            'id': self.id,
+            'measurement': self.type,
+            'state': 'on',
+            'protocol': self.protocol
+        }) + '\n').encode())
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.writable.set()
+
+    # Flow control of the transport, sending as fast as possible waits for the server to keep up
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+
+def read_tsv(path: str):
+    """
+    Stream the readings of a TSV archive (or a rotated .gz file) line by line
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != len(HEADER) or fields == HEADER:
+                continue
+            try:
+                yield wire.Reading(wire.parse_time(fields[0]), fields[1], fields[2], float(fields[3]), 0)
+            except ValueError:
+                continue
+
+
+def read_columnar(path: str):
+    """
+    Stream the readings of a columnar archive, the columns are memory-mapped segment by segment
+    """
+    for segment_path in list_segments(path):
+        segment = Segment(segment_path)
+        yield from segment.readings()
+        segment.close()
+
+
+def spread(readings):
+    """
+    TSV archives store the time to the second, the readings of a device within a second are spread evenly over it
+
+    Only the readings of one second are kept in memory.
+    """
+    for ts, group in itertools.groupby(readings, key=lambda reading: reading.ts):
+        group = list(group)
+        counts = {}
+        for reading in group:
+            counts[reading.device_id] = counts.get(reading.device_id, 0) + 1
+        seen = {}
+        spread_group = []
+        for reading in group:
+            index = seen.get(reading.device_id, 0)
+            seen[reading.device_id] = index + 1
+            spread_group.append(reading._replace(ts=ts + index * 1_000_000_000 // counts[reading.device_id]))
+        spread_group.sort(key=lambda reading: reading.ts)
+        yield from spread_group
+
+
+def read_archive(path: str):
+    if os.path.isdir(path):
+        return read_columnar(path)
+    return spread(read_tsv(path))
+
+
+class TraceReplay:
+    """
+    Streams archived readings into the server, every device of the trace gets its own connection.
+
+    The readings are sent at the times they were recorded, divided by the speed,
+    or as fast as the server accepts them with a speed of 0.
+    """
+
+    def __init__(self, addr: str, port: int, protocol: str = wire.BINARY, speed: float = 1.,
+                 original_time: bool = False):
+        """
+        :param original_time: send the recorded timestamps instead of the current time
+        """
+        self.addr = addr
+        self.port = port
+        self.protocol = protocol
+        self.speed = speed
+        self.original_time = original_time
+        self.devices = {}  # original device id -> ReplayDevice
+        self.sent = 0
+        self.behind = 0  # readings sent later than their time
+
+        self.log = logsetup.get_logger('Replay')
+
+    async def device(self, device_id: str, sensor_type: str) -> ReplayDevice:
+        device = self.devices.get(device_id)
+        if device is None or device.transport is None:
+            device = self.devices[device_id] = ReplayDevice(device_id, sensor_type, self.protocol)
+            await asyncio.get_running_loop().create_connection(lambda: device, self.addr, self.port)
+        return device
+
+    async def replay(self, readings, batch: int = 1000):
+        """
+        Send the readings of a trace, the time of the first reading is the start
+        """
+        start = first = None
+        for i, reading in enumerate(readings):
+            if first is None:
+                start, first = time.monotonic(), reading.ts
+
+            if self.speed > 0:
+                delay = start + (reading.ts - first) / 1_000_000_000 / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -0.1:
+                    self.behind += 1
+            elif i % batch == 0:
+                await asyncio.sleep(0)
+
+            device = await self.device(reading.device_id, reading.sensor_type)
+            if not device.writable.is_set():
+                await device.writable.wait()
+            if device.transport is None:
+                continue
+            device.send(reading.value, reading.ts if self.original_time else time.time_ns())
+            self.sent += 1
+
+    def close(self):
+        for device in self.devices.values():
+            if device.transport is not None:
+                device.transport.close()
+
+
+async def main(args: argparse.Namespace):
+    replay = TraceReplay(args.addr, args.port, args.protocol, args.speed, args.original_time)
+    started = time.monotonic()
+    for _ in range(args.repeat):
+        for path in args.path:
+            replay.log.info(f'Replaying {path}')
+            await replay.replay(read_archive(path))
+
+    elapsed = time.monotonic() - started
+    replay.log.info(f'Replayed {replay.sent} readings of {len(replay.devices)} devices in {elapsed:.1f} s '
+                    f'({replay.sent / max(elapsed, 1e-9):.0f}/s, {replay.behind} behind schedule)')
+    await asyncio.sleep(0.5)  # let the transports write out
+    replay.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay an archive into the server as device connections')
+    parser.add_argument('--path', help='TSV archive file (.txt or .txt.gz) or columnar archive directory, can be '
+                                       'repeated to replay rotated files in order', required=True, action='append')
+    parser.add_argument('--addr', help='Server address', required=False, default='127.0.0.1')
+    parser.add_argument('--port', help='Server port', required=False, default=50000, type=int)
+    parser.add_argument('--protocol', help='Wire protocol (e.g. json, binary)', required=False, default=wire.BINARY,
+                        choices=wire.PROTOCOLS)
+    parser.add_argument('--speed', help='Replay speed, 1 is real time, 10 ten times faster, 0 as fast as possible',
+                        required=False, default=1, type=float)
+    parser.add_argument('--repeat', help='Number of times the trace is replayed', required=False, default=1,
+                        type=int)
+    parser.add_argument('--original_time', help='Send the recorded timestamps instead of the current time',
+                        required=False, action='store_true')
+    logsetup.add_arguments(parser)
+    args = parser.parse_args()
+
+    logsetup.configure(args.log_format, args.log_rate)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt as e:
+        pass
@@ -0,0 +1,176 @@
+import asyncio
+import datetime
+import json
+import struct
+from typing import NamedTuple
+
+
+# Protocols negotiated during the {'type': ...} handshake
+JSON = 'json'
+BINARY = 'binary'
+
+PROTOCOLS = [JSON, BINARY]
+
+# JSON of subscribers whose handshake has no protocol field, they parse every line as a reading
+LEGACY = 'legacy'
+
+# Binary frames: uint32 body length, uint8 frame kind, body
+HEADER = struct.Struct('!IB')
+
+READING = 1  # handle uint16, seq uint32, timestamp int64 (ns), value float64, received int64 (ns), sent int64 (ns)
+DEVICE = 2   # handle uint16, device id and type as utf-8 separated by a tab
+TEXT = 3     # utf-8 text (commands, alarms, ...)
+
+READING_BODY = struct.Struct('!HIqdqq')
+DEVICE_BODY = struct.Struct('!H')
+
+MAX_HANDLE = 0xFFFF
+MAX_SEQ = 0xFFFFFFFF
+
+# Longest frame or line accepted, a bogus length must not make a connection buffer gigabytes
+MAX_FRAME = 64 * 1024  # from devices and consumers, like the line limit of asyncio streams
+MAX_MESSAGE = 16 * 1024 * 1024  # from the server, status replies and control messages grow with the devices
+
+
+class FrameTooLong(ValueError):
+    pass
+
+
+class Reading(NamedTuple):
+    """
+    Single measurement of a device as seen by the consumers
+    """
+    ts: int  # nanoseconds since epoch, taken by the device
+    device_id: str
+    sensor_type: str
+    value: float
+    seq: int
+    received: int = 0  # nanoseconds since epoch the server received the reading, 0 if not sent live
+    sent: int = 0  # nanoseconds since epoch the server handed the reading to the send queues
+
+
+def frame(kind: int, body: bytes) -> bytes:
+    return HEADER.pack(len(body), kind) + body
+
+
+def encode_reading(handle: int, seq: int, ts: int, value: float, received: int = 0, sent: int = 0) -> bytes:
+    """
+    Reading frame, devices leave the times of the server at 0
+    """
+    return HEADER.pack(READING_BODY.size, READING) + READING_BODY.pack(handle, seq & MAX_SEQ, ts, value, received,
+                                                                       sent)
+
+
+def encode_device(handle: int, device_id: str, device_type: str) -> bytes:
+    return frame(DEVICE, DEVICE_BODY.pack(handle) + f'{device_id}\t{device_type}'.encode())
+
+
+def encode_text(data: str, protocol: str) -> bytes:
+    """
+    Encode a text message (alarm, command, ...) for the given protocol
+    """
+    if protocol == BINARY:
+        return frame(TEXT, data.encode())
+    return (data + '\n').encode()
+
+
+def decode_device(body: bytes) -> tuple:
+    handle, = DEVICE_BODY.unpack_from(body)
+    device_id, device_type = body[DEVICE_BODY.size:].decode().split('\t')
+    return handle, device_id, device_type
+
+
+async def read_frame(reader: asyncio.StreamReader, max_length: int = MAX_FRAME):
+    """
+    Read a single frame from the stream
+
+    :param max_length: longest body accepted, FrameTooLong is raised for longer ones
+    :return: (kind, body) tuple or None when the connection is closed
+    """
+    try:
+        length, kind = HEADER.unpack(await reader.readexactly(HEADER.size))
+        if length > max_length:
+            raise FrameTooLong(f'Frame of {length} bytes over the limit of {max_length}')
+        return kind, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+_date_cache = {}
+
+
+def format_time(ts: int) -> str:
+    """
+    Human readable time of a timestamp in nanoseconds, formatted once per second
+    """
+    second = ts // 1_000_000_000
+    date = _date_cache.get(second)
+    if date is None:
+        if len(_date_cache) > 1024:
+            _date_cache.clear()
+        date = datetime.datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S')
+        _date_cache[second] = date
+    return date
+
+
+_ts_cache = {}
+
+
+def parse_time(date: str) -> int:
+    """
+    Timestamp in nanoseconds of a date formatted by the server
+    """
+    ts = _ts_cache.get(date)
+    if ts is None:
+        if len(_ts_cache) > 1024:
+            _ts_cache.clear()
+        ts = int(datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S').timestamp()) * 1_000_000_000
+        _ts_cache[date] = ts
+    return ts
+
+
+def encode_json(device_id: str, device_type: str, data: str, seq: int, ts: int, received: int = 0,
+                sent: int = 0) -> bytes:
+    """
+    Reading sent by the server as `[date, [id, type, value], {"seq": n, "ts": ns, ...}]`
+    """
+    meta = {'seq': seq, 'ts': ts, 'received': received, 'sent': sent}
+    return (json.dumps([format_time(ts), (device_id, device_type, data), meta]) + '\n').encode()
+
+
+def encode_legacy(device_id: str, device_type: str, data: str, ts: int) -> bytes:
+    """
+    Reading sent to older consumers as `[date, [id, type, value]]`, they print or parse every item after the date
+    """
+    return (json.dumps([format_time(ts), (device_id, device_type, data)]) + '\n').encode()
+
+
+def decode_json(line: str):
+    """
+    Turn a JSON line sent by the server into a reading
+
+    :return: Reading or the line itself if it is a text message
+    """
+    try:
+        message = json.loads(line)
+        date, (device_id, device_type, value) = message[:2]
+        meta = message[2] if len(message) > 2 else {}
+        return Reading(meta.get('ts') or parse_time(date), device_id, device_type, float(value), meta.get('seq', 0),
+                       meta.get('received', 0), meta.get('sent', 0))
+    except (ValueError, TypeError, AttributeError):
+        return line
+
+
+def decode_device_value(line: str, last_seq: int, received: int) -> tuple:
+    """
+    Value sent by a JSON device, either as {"seq": n, "ts": ns, "value": x} or as a bare number numbered
+    and timed by the server
+
+    :param received: time the server received the line, used for values without their own time
+    :return: (sequence number, timestamp in nanoseconds, value, value as text)
+    """
+    if line.startswith('{'):
+        message = json.loads(line)
+        value = float(message['value'])
+        return int(message['seq']), int(message.get('ts') or received), value, repr(value)
+    return last_seq + 1, received, float(line), line